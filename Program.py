@@ -1,6 +1,5 @@
 import asyncio
 import aiohttp
-import requests
 import customtkinter as ctk
 import tkinter as tk
 from tkinter import messagebox, filedialog
@@ -9,12 +8,43 @@ import time
 import json
 import threading
 import shutil
+import queue
+import bisect
+import random
+import hashlib
+import contextvars
+import csv
 from openpyxl import load_workbook
 import sys
-import win32com.client
 import re
-import winsound
 import webbrowser
+from array import array
+from collections import deque, Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from types import MappingProxyType
+
+try:
+    import winsound
+except ImportError:  # не Windows: звук через winsound недоступен
+    winsound = None
+
+try:
+    import win32com.client
+except ImportError:  # без pywin32 печать актов через Excel недоступна
+    win32com = None
+
+try:
+    import numpy as np
+except ImportError:  # без numpy статистика считается на array
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # без pyarrow выгрузка в Parquet/Arrow недоступна
+    pa = pc = pq = None
 
 # Глобальные переменные
 base_url, app_token, user_token = '', '', ''
@@ -41,13 +71,24 @@ entity_display = {
 use_indexing = True
 show_logs = True
 debug_mode = False
+write_trace = False
 sound_enabled = True
 print_copies = 2
 font_scale = 100
 main_window_size = '1350x600'
 extended_window_size = '1750x700'
 auth_window_size = '500x520'
-serial_index, entity_index = {}, {}
+index_refresh_minutes = 30
+lookup_workers = 8
+UPDATE_CHUNK_SIZE = 50
+UPDATE_MAX_ATTEMPTS = 4
+GET_CACHE_SECONDS = 2.0
+DETAIL_CHUNK_SIZE = 50
+PREFETCH_DELAY_MS = 300
+SESSION_PATHS = ('initSession', 'killSession', 'getFullSession')
+UNCACHED_GET_PATHS = SESSION_PATHS + ('getMultipleItems',)  # ответы не кэшируются и не объединяются
+index_build_lock = threading.Lock()
+index_publish_lock = threading.Lock()  # номер поколения и замена index_snapshot - одним шагом
 auth_history = []
 auth_success = False
 
@@ -55,6 +96,10 @@ if hasattr(sys, '_MEIPASS'):
     config_file = os.path.join(os.path.dirname(sys.executable), 'config.json')
 else:
     config_file = os.path.join(os.path.abspath("."), 'config.json')
+JOURNAL_DIR = os.path.join(os.path.dirname(config_file), 'journal')
+INDEX_CACHE_DIR = os.path.join(os.path.dirname(config_file), 'index_cache')
+CHANGES_DIR = os.path.join(os.path.dirname(config_file), 'changes')
+OFFLINE_PROBE_SECONDS = 30
 
 if os.path.exists(config_file):
     try:
@@ -69,12 +114,15 @@ if os.path.exists(config_file):
             use_indexing = config.get('use_indexing', True)
             show_logs = config.get('show_logs', True)
             debug_mode = config.get('debug_mode', False)
+            write_trace = config.get('write_trace', False)
             sound_enabled = config.get('sound_enabled', True)
             print_copies = config.get('print_copies', 2)
             font_scale = config.get('font_scale', 100)
             main_window_size = config.get('main_window_size', '1350x600')
             extended_window_size = config.get('extended_window_size', '1750x700')
             auth_window_size = config.get('auth_window_size', '500x520')
+            index_refresh_minutes = config.get('index_refresh_minutes', 30)
+            lookup_workers = config.get('lookup_workers', 8)
             auth_history = config.get('auth_history', [])
     except Exception as e:
         print(f"Ошибка чтения config.json: {e}")
@@ -98,12 +146,15 @@ def save_config():
         'use_indexing': use_indexing,
         'show_logs': show_logs,
         'debug_mode': debug_mode,
+        'write_trace': write_trace,
         'sound_enabled': sound_enabled,
         'print_copies': print_copies,
         'font_scale': font_scale,
         'main_window_size': main_window_size,
         'extended_window_size': extended_window_size,
         'auth_window_size': auth_window_size,
+        'index_refresh_minutes': index_refresh_minutes,
+        'lookup_workers': lookup_workers,
         'auth_history': auth_history
     }
     try:
@@ -133,95 +184,1712 @@ def trim_location(location):
     return location[len(prefix):] if location.startswith(prefix) else location
 
 
-async def fetch(session, url, headers, params):
-    async with session.get(url, headers=headers, params=params) as response:
-        return await response.json()
+def record_hash(values):
+    # 64-битный хэш содержимого записи (последовательности строк)
+    return int.from_bytes(hashlib.blake2b('\x1f'.join(values).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# Компактный индекс номеров: вместо полных записей GLPI хранятся кортежи только нужных
+# столбцов (строки через sys.intern), ключи лежат в отсортированных массивах, цифровые - числами.
+# Точный номер ищется bisect за O(log n); наружу записи отдаются новыми словарями (t, item).
+# Для каждой строки хранится хэш содержимого (без date_mod) - по нему поколения сравниваются без разбора полей
+class SerialIndex:
+    BASE_COLUMNS = ('id', 'name', 'otherserial', 'serial', 'date_mod')
+
+    def __init__(self, columns, types, type_codes, rows, hashes, num_keys, num_rows, str_keys, str_rows):
+        self.columns = columns
+        self.types = types
+        self.type_codes = type_codes
+        self.rows = rows
+        self.hashes = hashes
+        self.num_keys, self.num_rows = num_keys, num_rows
+        self.str_keys, self.str_rows = str_keys, str_rows
+
+    @staticmethod
+    def _is_numeric(key):
+        return key.isascii() and key.isdigit() and len(key) < 19
+
+    @classmethod
+    def build(cls, records):
+        # records: (тип, запись GLPI); при повторе номера побеждает последняя запись, как раньше в словаре
+        columns = cls.BASE_COLUMNS + tuple(f for f in dict.fromkeys(field_mappings.values())
+                                           if f != 'type' and f not in cls.BASE_COLUMNS)
+        hashed = [c for c in columns if c != 'date_mod']
+        types, type_codes, rows, hashes, keys = [], array('B'), [], array('Q'), {}
+        for t, item in records:
+            if t not in types:
+                types.append(t)
+            row = len(rows)
+            rows.append(tuple(sys.intern(v) if isinstance(v, str) else v for v in map(item.get, columns)))
+            type_codes.append(types.index(t))
+            hashes.append(record_hash(['' if v is None else str(v) for v in map(item.get, hashed)]))
+            for field in ('otherserial', 'serial'):
+                if key := str(item.get(field) or '').lstrip('0'):
+                    keys[key] = row
+        numeric = sorted((int(k), r) for k, r in keys.items() if cls._is_numeric(k))
+        strings = sorted((k, r) for k, r in keys.items() if not cls._is_numeric(k))
+        return cls(columns, tuple(types), type_codes, rows, hashes,
+                   array('Q', [k for k, _ in numeric]), array('I', [r for _, r in numeric]),
+                   [sys.intern(k) for k, _ in strings], array('I', [r for _, r in strings]))
+
+    def __len__(self):
+        return len(self.num_keys) + len(self.str_keys)
+
+    def find_row(self, key):
+        if self._is_numeric(key):
+            keys, rows, key = self.num_keys, self.num_rows, int(key)
+        else:
+            keys, rows = self.str_keys, self.str_rows
+        i = bisect.bisect_left(keys, key)
+        return rows[i] if i < len(keys) and keys[i] == key else None
+
+    def __contains__(self, key):
+        return self.find_row(key) is not None
+
+    def get(self, key, default=None):
+        row = self.find_row(key)
+        return default if row is None else self.item(row)
+
+    def item(self, row):
+        # Пустые столбцы не попадают в запись: item.get('name', 'Без имени') работает как с ответом GLPI
+        return self.types[self.type_codes[row]], {c: v for c, v in zip(self.columns, self.rows[row]) if v is not None}
+
+    def key_rows(self):
+        yield from zip(map(str, self.num_keys), self.num_rows)
+        yield from zip(self.str_keys, self.str_rows)
+
+    def records(self):
+        # Каждая позиция один раз, сколько бы номеров на неё ни указывало
+        return (self.item(row) for row in range(len(self.rows)))
+
+    def column(self, name):
+        k = self.columns.index(name)
+        return [row[k] for row in self.rows]
+
+
+# Неизменяемый снимок индекса. Индексатор собирает новое поколение и публикует его
+# одной заменой ссылки index_snapshot; читатели берут ссылку один раз и работают с ней
+class IndexSnapshot:
+    __slots__ = ('generation', 'built_at', 'source', 'serials', 'entities', 'by_field', 'locations')
+
+    def __init__(self, generation, built_at, serials, entities, source=''):
+        self.generation = generation
+        self.built_at = built_at
+        self.source = source  # base_url сервера, с которого построено поколение
+        self.serials = serials if isinstance(serials, SerialIndex) else SerialIndex.build(serials.values())
+        self.entities = MappingProxyType({k: frozenset(v) if isinstance(v, set) else MappingProxyType(v)
+                                          for k, v in entities.items()})
+        self.by_field = MappingProxyType({f: MappingProxyType(postings)
+                                          for f, postings in build_field_index(self.serials).items()})
+        self.locations = LocationTree(self.entities.get('Location', {}), self.by_field['locations_id'],
+                                      self.serials.item)
+
+    def items_by(self, field, value):
+        return [self.serials.item(row) for row in self.by_field.get(field, {}).get(str(value), ())]
+
+
+# Поля с обратными индексами "значение -> позиции" и справочники, из которых берутся их значения
+INDEXED_FIELDS = {'users_id': 'User', 'groups_id': 'Group', 'locations_id': 'Location',
+                  'states_id': 'State', 'contact': 'Contact'}
+
+
+def build_field_index(serials):
+    # Списки строк SerialIndex по значению поля; каждая позиция в индексе номеров - одна строка
+    postings = {}
+    for f in INDEXED_FIELDS:
+        index = postings[f] = {}
+        if f not in serials.columns:
+            continue
+        for row, value in enumerate(serials.column(f)):
+            if value not in (None, '', 0):
+                index.setdefault(str(value), array('I')).append(row)
+    return postings
+
+
+# Дерево местоположений по completename "A > B > C": родитель - путь без последней части.
+# Узлы пронумерованы обходом в глубину, поэтому поддерево узла - отрезок order[start:end]:
+# выборка "всё внутри" стоит O(размера ответа), проверка вложенности - O(1)
+class LocationTree:
+    def __init__(self, locations, postings, item):
+        self.paths = {k: v for k, v in locations.items() if isinstance(v, str) and v != 'Не указано'}
+        self.postings = postings
+        self.item = item
+        path_ids = {}
+        for k, path in self.paths.items():
+            path_ids.setdefault(path, k)
+        self.parent, children = {}, {}
+        for k, path in self.paths.items():
+            parent = path_ids.get(path.rsplit(' > ', 1)[0]) if ' > ' in path else None
+            self.parent[k] = parent
+            children.setdefault(parent, []).append(k)
+        for nodes in children.values():
+            nodes.sort(key=lambda k: self.paths[k].lower(), reverse=True)
+        self.order, self.start, self.end, self.own, self.total = [], {}, {}, {}, {}
+        stack = [(k, False) for k in children.get(None, ())]
+        while stack:
+            k, closing = stack.pop()
+            if closing:
+                # Дети уже обработаны: итог поддерева считается один раз при построении
+                self.end[k] = len(self.order)
+                self.total[k] = self.own[k] + sum(self.total[c] for c in children.get(k, ()))
+                continue
+            self.start[k] = len(self.order)
+            self.order.append(k)
+            self.own[k] = len(postings.get(k, ()))
+            stack.append((k, True))
+            stack.extend((c, False) for c in children.get(k, ()))
+
+    def subtree(self, k):
+        return self.order[self.start[k]:self.end[k]] if k in self.start else []
+
+    def contains(self, ancestor, k):
+        return ancestor in self.start and k in self.start and \
+            self.start[ancestor] <= self.start[k] < self.end[ancestor]
+
+    def items(self, k):
+        return [self.item(row) for loc in self.subtree(k) for row in self.postings.get(loc, ())]
+
+    def depth(self, k):
+        return self.paths[k].count(' > ')
+
+
+index_snapshot = IndexSnapshot(0, 0.0, {}, {})
+
+TYPE_NAMES = {'Computer': 'Компьютер', 'Monitor': 'Монитор', 'Peripheral': 'Устройство'}
+
+
+# Столбцовое представление поколения индекса для статистики: тип позиции и каждое поле из
+# INDEXED_FIELDS хранятся массивом целочисленных кодов (0 - пусто) со списком значений кодов.
+# Группировки - подсчёт кодов: numpy.bincount, без numpy - Counter по array
+class FleetStats:
+    def __init__(self, serials):
+        self.codes = {'type': array('I', serials.type_codes)}
+        self.values = {'type': list(serials.types)}
+        for field in INDEXED_FIELDS:
+            if field not in serials.columns:
+                continue
+            k, values, lookup = serials.columns.index(field), [''], {}
+            codes = array('I')
+            for row in serials.rows:
+                value = row[k]
+                if not value:
+                    codes.append(0)
+                    continue
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(values)
+                    values.append(str(value))
+                codes.append(code)
+            self.codes[field], self.values[field] = codes, values
+        if np is not None:
+            self.codes = {f: np.frombuffer(c, dtype=np.uint32) for f, c in self.codes.items()}
+
+    def count(self, field):
+        # {значение: число позиций}; пустое значение - ''
+        codes, values = self.codes[field], self.values[field]
+        if np is not None:
+            counts = np.bincount(codes, minlength=len(values)).tolist()
+            return {values[k]: n for k, n in enumerate(counts) if n}
+        return {values[k]: n for k, n in Counter(codes).items()}
+
+    def crosstab(self, row_field, column_field):
+        # {(значение строки, значение столбца): число позиций}
+        rows, columns = self.codes[row_field], self.codes[column_field]
+        row_values, column_values = self.values[row_field], self.values[column_field]
+        width = len(column_values)
+        if np is not None:
+            counts = np.bincount(rows.astype(np.int64) * width + columns, minlength=len(row_values) * width).tolist()
+            pairs = ((k, n) for k, n in enumerate(counts) if n)
+        else:
+            pairs = Counter(r * width + c for r, c in zip(rows, columns)).items()
+        return {(row_values[k // width], column_values[k % width]): n for k, n in pairs}
+
+
+# Инструментирование горячих путей: тайминги, объёмы, попадания в кэши
+class PerfStats:
+    MAX_SAMPLES = 2048
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trace_lock = threading.Lock()  # только порядок строк в trace-файле; счётчики файл не ждут
+        self.spans = {}
+        self.caches = {}
+        self.trace_path = os.path.join(os.path.dirname(config_file), 'trace.jsonl')
+
+    def record(self, name, duration, nbytes=0, error=False, **attrs):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = {'count': 0, 'errors': 0, 'bytes': 0, 'total': 0.0,
+                                           'samples': deque(maxlen=self.MAX_SAMPLES)}
+            span['count'] += 1
+            span['errors'] += int(error)
+            span['bytes'] += nbytes
+            span['total'] += duration
+            span['samples'].append(duration)
+        if debug_mode and write_trace:
+            self._trace({'ts': round(time.time(), 3), 'span': name, 'ms': round(duration * 1000, 2),
+                         'bytes': nbytes, 'error': error, 'thread': threading.current_thread().name, **attrs})
+
+    def cache(self, name, hit):
+        with self.lock:
+            counters = self.caches.setdefault(name, [0, 0])
+            counters[0 if hit else 1] += 1
+
+    def _trace(self, entry):
+        try:
+            line = json.dumps(entry, ensure_ascii=False, default=str)
+            with self.trace_lock, open(self.trace_path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"Ошибка записи trace-файла: {e}")
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.caches.clear()
+
+    @staticmethod
+    def _percentile(ordered, q):
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def summary(self):
+        with self.lock:
+            spans = {k: (dict(v), sorted(v['samples'])) for k, v in self.spans.items()}
+            caches = {k: tuple(v) for k, v in self.caches.items()}
+        rows = []
+        for name in sorted(spans):
+            span, ordered = spans[name]
+            rows.append({'name': name, 'count': span['count'], 'errors': span['errors'], 'bytes': span['bytes'],
+                         'avg': span['total'] / span['count'] if span['count'] else 0.0,
+                         'p50': self._percentile(ordered, 0.50), 'p95': self._percentile(ordered, 0.95),
+                         'p99': self._percentile(ordered, 0.99)})
+        cache_rows = [{'name': name, 'hits': hits, 'misses': misses,
+                       'rate': hits / (hits + misses) if hits + misses else 0.0}
+                      for name, (hits, misses) in sorted(caches.items())]
+        return rows, cache_rows
+
+
+perf = PerfStats()
+
+
+@contextmanager
+def timed(name, **attrs):
+    # span['bytes'] и span['error'] можно заполнить внутри блока
+    span = {'bytes': 0, 'error': False}
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span['error'] = True
+        raise
+    finally:
+        perf.record(name, time.perf_counter() - started, span['bytes'], span['error'], **attrs)
+
+
+def span_name(method, path):
+    # Computer/123 -> Computer/{id}, чтобы не плодить отдельный span на каждый объект
+    return f"http {method} " + '/'.join('{id}' if part.isdigit() else part for part in path.split('/'))
+
+
+class GLPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+# Один долгоживущий цикл asyncio в фоновом потоке и одна сессия aiohttp на всё приложение:
+# поиск, карточки, изменения и индексация используют общий пул соединений
+class AsyncService:
+    def __init__(self):
+        self.loop = None
+        self.session = None
+        self.thread = None
+        self.started = threading.Event()
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='glpi-async', daemon=True)
+                self.thread.start()
+        self.started.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.started.set()
+        self.loop.run_forever()
+
+    async def get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300))
+        return self.session
+
+    def submit(self, coro):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro, timeout=60):
+        # Блокирующий вызов для потока Tk и рабочих потоков; сам цикл asyncio его вызывать не должен.
+        # По истечении timeout корутина отменяется, вызывающий получает GLPIError, а не зависает
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise GLPIError(f"Нет ответа за {timeout} с") from None
+
+    def stop(self):
+        if self.loop is None:
+            return
+        if self.session is not None:
+            try:
+                self.submit(self.session.close()).result(timeout=5)
+            except Exception as e:
+                print(f"Ошибка закрытия HTTP-сессии: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+async_service = AsyncService()
+
+
+# AIMD-ограничитель одновременных запросов к GLPI: пока задержки в норме и очередь упирается
+# в лимит, он растёт примерно на единицу за окно ответов; на 429/5xx/таймаут лимит уменьшается вдвое,
+# при росте p95 относительно базовой задержки своего типа запроса - на 10%.
+# Работает только в потоке цикла asyncio
+class AdaptiveLimiter:
+    MIN_LIMIT, MAX_LIMIT = 2, 32
+    P95_RATIO = 3.0
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, initial=8):
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.waiters = deque()
+        self.baselines = {}  # вид запроса (метод, путь, размер страницы) -> минимальная задержка, медленно "забывается"
+        self.ratios = deque(maxlen=50)
+        self.last_decrease = 0.0
+        self.decreases = 0
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                else:
+                    self._wake()  # нас уже разбудили - передаём место следующему
+                raise
+        self.in_flight += 1
+
+    def release(self, shape, latency, outcome):
+        # outcome: 'ok', 'overloaded' (429, 5xx, таймаут) или 'error' (прочие ошибки - без влияния на лимит).
+        # Базовая задержка считается только по успешным ответам одного вида: быстрые ошибки и короткие
+        # страницы не занижают её для полной выгрузки таблицы
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        now = time.monotonic()
+        if outcome == 'overloaded':
+            self._decrease(0.5, now)
+        elif outcome == 'ok':
+            base = self.baselines.get(shape)
+            base = latency if base is None else min(latency, base * 1.01)
+            self.baselines[shape] = base
+            self.ratios.append(latency / base if base > 0 else 1.0)
+            if len(self.ratios) >= 20 and PerfStats._percentile(sorted(self.ratios), 0.95) > self.P95_RATIO:
+                self._decrease(0.9, now)
+            elif saturated:
+                # Лимит растёт, только когда в него действительно упираются
+                self.limit = min(self.MAX_LIMIT, self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def _decrease(self, factor, now):
+        # Одна волна ошибок снижает лимит один раз, а не на каждый ответ
+        if now - self.last_decrease < self.DECREASE_INTERVAL:
+            return
+        self.limit = max(self.MIN_LIMIT, self.limit * factor)
+        self.last_decrease = now
+        self.decreases += 1
+        self.ratios.clear()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+limiter = AdaptiveLimiter()
+
+
+# Звуковые сигналы играются в отдельном потоке: сканирование и интерфейс не ждут окончания
+# сигнала. Сигналы, накопившиеся, пока играл предыдущий, сливаются: не больше одного
+# сигнала ошибки и одного сигнала успеха на пачку, ошибка звучит первой
+class FeedbackService:
+    TONES = {True: (1000, 200), False: (500, 300)}
+
+    def __init__(self, backend):
+        self.backend = backend  # backend(частота, длительность_мс), вызывается только из потока сигналов
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def play(self, success):
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='feedback', daemon=True)
+                self.thread.start()
+        self.queue.put(bool(success))
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+
+    def _run(self):
+        while True:
+            pending = [self.queue.get()]
+            while True:
+                try:
+                    pending.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in pending:
+                return
+            tones = [tone for tone in (False, True) if tone in pending]
+            for tone in tones:
+                try:
+                    self.backend(*self.TONES[tone])
+                except Exception as e:
+                    print(f"Ошибка воспроизведения сигнала: {e}")
+
+
+def winsound_backend(frequency, duration):
+    winsound.Beep(frequency, duration)
+
+
+def silent_backend(frequency, duration):
+    pass
+
+
+feedback = FeedbackService(winsound_backend if winsound else silent_backend)
+
+
+# Подключение, через которое идут запросы текущей задачи asyncio: (base_url, headers).
+# По умолчанию - основное подключение из глобальных base_url и headers; сравнение экземпляров
+# задаёт своим задачам второе, и индексатор работает с ним без изменений
+glpi_connection = contextvars.ContextVar('glpi_connection', default=None)
+
+
+def current_connection():
+    return glpi_connection.get() or (base_url, headers)
+
+
+async def glpi_request_async(method, path, params=None, payload=None, timeout=10):
+    if method == 'GET' and path not in UNCACHED_GET_PATHS:
+        body = await _coalesced_get(path, params, timeout)
+    else:
+        body = await _glpi_body(method, path, params, payload, timeout)
+        if method != 'GET':
+            invalidate_get_cache(path.split('/')[0])
+    try:
+        return json.loads(body) if body else None
+    except ValueError as e:
+        # Обрезанный ответ или HTML-страница ошибки вместо JSON
+        raise GLPIError(f"Некорректный ответ сервера ({path}): {e}") from e
+
+
+async def _glpi_body(method, path, params, payload, timeout):
+    # Истёкшая сессия (401) обновляется через initSession с сохранёнными токенами,
+    # после чего запрос повторяется один раз
+    url, request_headers = current_connection()
+    token = request_headers.get('Session-Token')
+    try:
+        return await _glpi_send(method, path, params, payload, timeout, request_headers)
+    except GLPIError as e:
+        if e.status != 401 or not token or path in SESSION_PATHS:
+            raise
+    await renew_session(token)
+    return await _glpi_send(method, path, params, payload, timeout, request_headers)
+
+
+# Одинаковые GET, запрошенные одновременно, идут на сервер одним запросом, а ответ
+# ещё GET_CACHE_SECONDS отдаётся из памяти. Хранится тело ответа: каждый получатель
+# разбирает свою копию и может менять её, не задевая остальных.
+# Поколение типа растёт при каждом изменении: GET, начатый до PUT, в кэш уже не попадёт
+_get_inflight = {}
+_get_cache = {}
+_get_generation = Counter()
+
+
+async def _coalesced_get(path, params, timeout):
+    key = (current_connection()[0], path, tuple(sorted((params or {}).items())))
+    cached = _get_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        perf.cache('http_get', True)
+        return cached[1]
+    task = _get_inflight.get(key)
+    perf.cache('http_get', task is not None)
+    if task is None:
+        generation = _get_generation[path.split('/')[0]]
+        task = _get_inflight[key] = asyncio.ensure_future(_glpi_body('GET', path, params, None, timeout))
+        task.add_done_callback(lambda t: _get_finished(key, t, generation))
+    return await asyncio.shield(task)
+
+
+def _get_finished(key, task, generation):
+    if _get_inflight.get(key) is task:
+        del _get_inflight[key]
+    if task.cancelled() or task.exception() is not None or generation != _get_generation[key[1].split('/')[0]]:
+        return
+    entry = _get_cache[key] = (time.monotonic() + GET_CACHE_SECONDS, task.result())
+    # Тела ответов (целые таблицы оборудования) не должны жить в памяти дольше срока кэша
+    task.get_loop().call_later(GET_CACHE_SECONDS, _get_expired, key, entry)
+
+
+def _get_expired(key, entry):
+    if _get_cache.get(key) is entry:
+        del _get_cache[key]
+
+
+def invalidate_get_cache(itemtype):
+    # После изменения кэш чтений этого типа сбрасывается, чтобы не показать старые данные;
+    # новые GET не присоединяются к запросам, ушедшим до изменения
+    _get_generation[itemtype] += 1
+    for k in [k for k in _get_cache if k[1].split('/')[0] == itemtype]:
+        del _get_cache[k]
+    for k in [k for k in _get_inflight if k[1].split('/')[0] == itemtype]:
+        del _get_inflight[k]
+
+
+_session_renewal = {}
+
+
+async def renew_session(stale_token):
+    # Все запросы, получившие 401 с одним и тем же токеном, ждут одно общее обновление своего подключения
+    url, request_headers = current_connection()
+    if request_headers.get('Session-Token') != stale_token:
+        return  # сессию уже обновил другой запрос
+    task = _session_renewal.get(url)
+    if task is None or task.done():
+        task = _session_renewal[url] = asyncio.ensure_future(_renew_session(request_headers))
+    await asyncio.shield(task)
+
+
+async def _renew_session(request_headers):
+    with timed('session.renew'):
+        try:
+            body = await _glpi_send('GET', 'initSession', None, None, 10,
+                                    {k: v for k, v in request_headers.items() if k != 'Session-Token'})
+            data = json.loads(body) if body else None
+        except GLPIError as e:
+            raise GLPIError(f"Не удалось обновить сессию: {e}", e.status) from e
+        except ValueError as e:
+            raise GLPIError(f"Не удалось обновить сессию: {e}") from e
+    if not isinstance(data, dict) or 'session_token' not in data:
+        raise GLPIError(f"Не удалось обновить сессию: некорректный ответ {data}")
+    request_headers['Session-Token'] = data['session_token']
+    if debug_mode:
+        print("DEBUG: сессия GLPI обновлена")
+
+
+async def _glpi_send(method, path, params, payload, timeout, request_headers):
+    session = await async_service.get_session()
+    url = current_connection()[0]
+    name = span_name(method, path)
+    first, _, last = str((params or {}).get('range', '')).partition('-')
+    page = int(last) - int(first) + 1 if first.isdigit() and last.isdigit() else None
+    await limiter.acquire()
+    started, outcome = time.perf_counter(), 'error'
+    try:
+        with timed(name) as span:
+            try:
+                async with session.request(method, f'{url}/{path}', headers=request_headers, params=params,
+                                           json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    body = await response.read()
+                    span['bytes'] = len(body)
+                    if response.status >= 400:
+                        if response.status == 429 or response.status >= 500:
+                            outcome = 'overloaded'
+                        raise GLPIError(f"HTTP {response.status}: {body[:300].decode('utf-8', 'replace')}",
+                                        response.status)
+            except asyncio.TimeoutError as e:
+                outcome = 'overloaded'
+                raise GLPIError(f"Превышено время ожидания ({timeout} с)") from e
+            except aiohttp.ClientError as e:
+                raise GLPIError(str(e) or type(e).__name__) from e
+        outcome = 'ok'
+    finally:
+        limiter.release((name, page), time.perf_counter() - started, outcome)
+    return body
+
+
+def glpi_request(method, path, params=None, payload=None, timeout=10):
+    # Запас сверх timeout запроса: ожидание в очереди ограничителя и обновление сессии с повтором
+    return async_service.call(glpi_request_async(method, path, params, payload, timeout), timeout * 2 + 15)
+
+
+async def glpi_update_items(itemtype, inputs):
+    # Массовое изменение: один PUT /itemtype со списком input, в каждом элементе свой id.
+    # GLPI отвечает списком вида [{"<id>": true, "message": ""}, ...]
+    response = await glpi_request_async('PUT', itemtype, payload={'input': inputs}, timeout=30)
+    statuses = {}
+    for entry in response if isinstance(response, list) else [response]:
+        if isinstance(entry, dict):
+            message = entry.get('message', '')
+            for key, value in entry.items():
+                if key != 'message':
+                    statuses[str(key)] = (bool(value), message)
+    return statuses
+
+
+async def glpi_get_multiple(keys):
+    # Полные записи для [(тип, id)] через getMultipleItems с expand_dropdowns: ссылки на справочники
+    # приходят уже названиями. Порции по DETAIL_CHUNK_SIZE одного типа (ответ сопоставляется по id)
+    # запрашиваются параллельно; возвращает ({(тип, id): запись}, число неудачных порций)
+    async def fetch(t, ids):
+        params = {'expand_dropdowns': 'true'}
+        for k, item_id in enumerate(ids):
+            params[f'items[{k}][itemtype]'] = t
+            params[f'items[{k}][items_id]'] = item_id
+        data = await glpi_request_async('GET', 'getMultipleItems', params=params, timeout=30)
+        if not isinstance(data, list):
+            raise GLPIError(f"Некорректный ответ getMultipleItems: {data}")
+        return {(t, entry['id']): entry for entry in data if isinstance(entry, dict) and 'id' in entry}
+
+    by_type = {}
+    for t, item_id in keys:
+        by_type.setdefault(t, []).append(item_id)
+    chunks = [(t, ids[k:k + DETAIL_CHUNK_SIZE]) for t, ids in by_type.items()
+              for k in range(0, len(ids), DETAIL_CHUNK_SIZE)]
+    details, failed = {}, 0
+    with timed('details.prefetch', items=len(keys)):
+        for result in await asyncio.gather(*[fetch(t, ids) for t, ids in chunks], return_exceptions=True):
+            if isinstance(result, Exception):
+                failed += 1
+                print(f"Ошибка загрузки полных записей: {result}")
+            else:
+                details.update(result)
+    return details, failed
+
+
+# Журнал массового изменения (write-ahead): до отправки на диск пишутся все позиции,
+# после каждого ответа - их новое состояние. Прерванная операция продолжается
+# с того места, где остановилась, успешно отправленное повторно не уходит
+class UpdateJournal:
+    def __init__(self, path, header, entries):
+        self.path = path
+        self.header = header
+        self.entries = entries  # ключ "тип/id" -> состояние позиции
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, description, plan, queued=False):
+        # queued - операция поставлена в очередь офлайн и отправляется без вопросов при появлении связи
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        path = os.path.join(JOURNAL_DIR, f"bulk_{time.time_ns()}.jsonl")
+        header = {'description': description, 'base_url': base_url, 'created': time.time(), 'queued': queued}
+        entries = {}
+        for s, t, i, fields in plan:
+            entries[f"{t}/{i['id']}"] = {'serial': s, 'type': t, 'id': i['id'], 'fields': fields,
+                                        'state': 'pending', 'attempts': 0, 'message': ''}
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'header': header}, ensure_ascii=False) + "\n")
+            for key, entry in entries.items():
+                f.write(json.dumps({'key': key, **entry}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return cls(path, header, entries)
+
+    @classmethod
+    def load(cls, path):
+        header, entries = None, {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # строка, оборванная при аварийном завершении
+                if 'header' in record:
+                    header = record['header']
+                elif 'fields' in record:
+                    entries[record['key']] = {k: v for k, v in record.items() if k != 'key'}
+                elif record.get('key') in entries:
+                    entries[record['key']].update(state=record['state'], attempts=record['attempts'],
+                                                  message=record.get('message', ''))
+        return cls(path, header, entries) if header else None
+
+    @staticmethod
+    def unfinished(skip=()):
+        if not os.path.isdir(JOURNAL_DIR):
+            return []
+        journals = []
+        for name in sorted(os.listdir(JOURNAL_DIR)):
+            if not name.endswith('.jsonl') or os.path.join(JOURNAL_DIR, name) in skip:
+                continue
+            try:
+                journal = UpdateJournal.load(os.path.join(JOURNAL_DIR, name))
+            except OSError as e:
+                print(f"Ошибка чтения журнала {name}: {e}")
+                continue
+            if journal and journal.header.get('base_url') == base_url and journal.outstanding():
+                journals.append(journal)
+        return journals
+
+    def mark(self, results):
+        # results: [(ключ, успех, сообщение)]; одна запись на диск на пачку
+        with self.lock:
+            lines = []
+            for key, ok, message in results:
+                entry = self.entries[key]
+                entry['state'] = 'done' if ok else 'failed'
+                entry['attempts'] += 1
+                entry['message'] = message
+                lines.append(json.dumps({'key': key, 'state': entry['state'], 'attempts': entry['attempts'],
+                                         'message': message}, ensure_ascii=False))
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def queue(self):
+        # Перевод в очередь: обновлённый заголовок дописывается в конец, load берёт последний
+        with self.lock:
+            if self.header.get('queued'):
+                return
+            self.header['queued'] = True
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'header': self.header}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def outstanding(self):
+        return [(key, entry) for key, entry in self.entries.items() if entry['state'] != 'done']
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            print(f"Ошибка удаления журнала {self.path}: {e}")
+
+    def finish(self):
+        if not self.outstanding():
+            self.discard()
 
 
 async def index_data_async(app):
-    global serial_index, entity_index
-    app.log("Начало переиндексации данных...")
-    serial_index.clear()
-    entity_index.clear()
+    with timed('index.total'):
+        await _index_data_async(app)
+
+
+async def _index_entity(app, entity, new_entity):
+    # Возвращает True, если сущность загружена без ошибок
+    phase_started = time.perf_counter()
+    new_entity[entity] = {}
+    start, step = 0, 500
+    ok = True
+    while True:
+        try:
+            data = await glpi_request_async('GET', entity, params={'range': f'{start}-{start + step - 1}'})
+        except (GLPIError, ValueError) as e:
+            app.log(f"Ошибка индексации {entity}: {e}")
+            ok = False
+            break
+        if not isinstance(data, list):
+            app.log(f"Некорректный ответ для {entity}: {data}")
+            ok = False
+            break
+        for i in data:
+            if 'id' not in i:
+                app.log(f"Отсутствует 'id' в записи {entity}: {i}")
+                continue
+            field1, field2, _ = entity_display[entity] if len(entity_display[entity]) >= 2 else (entity_display[entity][0], '', '')
+            display_value = i.get(field1, 'Не указано')
+            if entity == 'User':
+                display_value = f"{i.get('realname', '')} {i.get('firstname', '')}".strip()
+            new_entity[entity][str(i['id'])] = display_value
+        app.log(f"Индексация {entity}: {start}-{start + len(data) - 1}")
+        if len(data) < step:
+            break
+        start += step
+    perf.record(f'index.{entity}', time.perf_counter() - phase_started)
+    app.log(f"Индексация {entity} завершена, элементов: {len(new_entity[entity])}")
+    return ok
+
+
+async def collect_index(app):
+    # Загружает таблицы оборудования и справочники текущего подключения без публикации:
+    # возвращает (записи (тип, запись GLPI), справочники, были ли ошибки)
+    records, new_entity = [], {}
+    failed = False
     item_types = {'Computer': 'Компьютеры', 'Monitor': 'Мониторы', 'Peripheral': 'Устройства'}
 
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for t in item_types:
-            url = f'{base_url}/{t}'
-            tasks.append(fetch(session, url, headers, {'range': '0-9999'}))
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Таблицы оборудования и справочники загружаются параллельно через общую сессию
+    entity_tasks = [asyncio.ensure_future(_index_entity(app, entity, new_entity))
+                    for entity in ['User', 'Group', 'Location', 'State']]
+    with timed('index.items.fetch'):
+        results = await asyncio.gather(*[glpi_request_async('GET', t, params={'range': '0-9999'})
+                                         for t in item_types], return_exceptions=True)
+    # Поле contact собирается из тех же ответов, без повторной загрузки таблиц
+    new_entity['Contact'] = set()  # Используем set для уникальных значений
+    with timed('index.contact'):
         for t, result in zip(item_types, results):
             if isinstance(result, Exception):
                 app.log(f"Ошибка индексации {t}: {result}")
+                failed = True
                 continue
             if not isinstance(result, list):
                 app.log(f"Некорректный ответ для {t}: {result}")
+                failed = True
                 continue
             for item in result:
                 if not isinstance(item, dict):
                     app.log(f"Некорректная запись в {t}: {item}")
                     continue
-                if s := item.get('otherserial'):
-                    serial_index[s.lstrip('0')] = (t, item)
-                if s := item.get('serial'):
-                    serial_index[s.lstrip('0')] = (t, item)
+                records.append((t, item))
+                if contact := item.get('contact'):
+                    new_entity['Contact'].add(contact)
             app.log(f"Индексация {t} завершена")
 
-        # Индексация поля contact
-        entity_index['Contact'] = set()  # Используем set для уникальных значений
-        for t in item_types:
-            url = f'{base_url}/{t}'
-            tasks = [fetch(session, url, headers, {'range': '0-9999'})]
-            data = await asyncio.gather(*tasks, return_exceptions=True)
-            data = data[0]
-            if isinstance(data, Exception):
-                app.log(f"Ошибка индексации Contact для {t}: {data}")
-                continue
-            if not isinstance(data, list):
-                app.log(f"Некорректный ответ для Contact в {t}: {data}")
-                continue
-            for item in data:
-                if not isinstance(item, dict):
-                    app.log(f"Некорректная запись Contact в {t}: {item}")
-                    continue
-                if contact := item.get('contact'):
-                    entity_index['Contact'].add(contact)
-            app.log(f"Индексация Contact для {t} завершена")
+    # Индексация остальных сущностей (без AutoUpdateSystem)
+    if not all(await asyncio.gather(*entity_tasks)):
+        failed = True
+    return records, new_entity, failed
 
-        # Индексация остальных сущностей (без AutoUpdateSystem)
-        for entity in ['User', 'Group', 'Location', 'State']:
-            entity_index[entity] = {}
-            start, step = 0, 500
-            while True:
-                tasks = [fetch(session, f'{base_url}/{entity}', headers, {'range': f'{start}-{start + step - 1}'})]
-                data = await asyncio.gather(*tasks, return_exceptions=True)
-                data = data[0]
-                if isinstance(data, Exception):
-                    app.log(f"Ошибка индексации {entity}: {data}")
-                    break
-                if not isinstance(data, list):
-                    app.log(f"Некорректный ответ для {entity}: {data}")
-                    break
-                for i in data:
-                    if 'id' not in i:
-                        app.log(f"Отсутствует 'id' в записи {entity}: {i}")
-                        continue
-                    field1, field2, _ = entity_display[entity] if len(entity_display[entity]) >= 2 else (entity_display[entity][0], '', '')
-                    display_value = i.get(field1, 'Не указано')
-                    if entity == 'User':
-                        display_value = f"{i.get('realname', '')} {i.get('firstname', '')}".strip()
-                    entity_index[entity][str(i['id'])] = display_value
-                app.log(f"Индексация {entity}: {start}-{start + len(data) - 1}")
-                if len(data) < step:
-                    break
-                start += step
-            app.log(f"Индексация {entity} завершена, элементов: {len(entity_index[entity])}")
-    app.log("Переиндексация завершена")
+
+async def _index_data_async(app):
+    # Новое поколение строится в локальных словарях и публикуется целиком,
+    # чтобы поиск во время переиндексации не видел пустой или частичный индекс
+    app.log("Начало переиндексации данных...")
+    source = base_url
+    records, new_entity, failed = await collect_index(app)
+    if failed and index_snapshot.serials and index_snapshot.source == source:
+        app.log("Переиндексация завершилась с ошибками, оставлен предыдущий индекс")
+        return
+    with timed('index.serials_build'):
+        new_serial = await asyncio.get_running_loop().run_in_executor(None, SerialIndex.build, records)
+    del records  # полные записи GLPI больше не нужны
+    if source != base_url:
+        app.log("Сервер сменился во время индексации, результат отброшен")
+        return
+    previous = index_snapshot
+    snapshot = await asyncio.get_running_loop().run_in_executor(None, publish_index, new_serial, new_entity,
+                                                                 None, source)
+    app.log(f"Переиндексация завершена, поколение индекса: {snapshot.generation}")
+    await record_changes(app, previous, snapshot)
+    if not failed:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, save_index_cache, snapshot)
+        except (OSError, TypeError, ValueError) as e:
+            app.log(f"Ошибка сохранения индекса на диск: {e}")
+
+
+async def _fetch_changed(t, since, step=500):
+    # Записи, изменённые начиная с since (date_mod сервера), постранично от новых к старым
+    changed, start = [], 0
+    while True:
+        data = await glpi_request_async('GET', t, params={'range': f'{start}-{start + step - 1}',
+                                                          'sort': 'date_mod', 'order': 'DESC'})
+        if not isinstance(data, list):
+            raise ValueError(f"Некорректный ответ для {t}: {data}")
+        changed += [i for i in data if isinstance(i, dict) and (i.get('date_mod') or '') >= since]
+        if len(data) < step or not data or (data[-1].get('date_mod') or '') < since:
+            return changed
+        start += step
+
+
+async def delta_index_async(app):
+    with timed('index.delta'):
+        await _delta_index_async(app)
+
+
+async def _delta_index_async(app):
+    # Дозагрузка к опубликованному поколению: таблицы оборудования запрашиваются
+    # отсортированными по date_mod и только до последнего уже известного изменения.
+    # Удалённые позиции так не видны - их убирает плановая полная переиндексация
+    base, source = index_snapshot, base_url
+    if not base.serials or base.source != source:
+        return await _index_data_async(app)
+    app.log("Дельта-индексация от сохранённого индекса...")
+    item_types = ['Computer', 'Monitor', 'Peripheral']
+    # Последнее известное изменение по каждому типу - по столбцу date_mod, без сборки записей
+    since = {t: '' for t in item_types}
+    for code, date_mod in zip(base.serials.type_codes, base.serials.column('date_mod')):
+        t = base.serials.types[code]
+        since[t] = max(since.get(t, ''), date_mod or '')
+
+    new_entity = {}
+    entity_names = ['User', 'Group', 'Location', 'State']
+    entity_tasks = [asyncio.ensure_future(_index_entity(app, entity, new_entity)) for entity in entity_names]
+    results = await asyncio.gather(*[_fetch_changed(t, since[t]) for t in item_types], return_exceptions=True)
+    failed, changed = False, []
+    for t, result in zip(item_types, results):
+        if isinstance(result, Exception):
+            app.log(f"Ошибка дельта-индексации {t}: {result}")
+            failed = True
+            continue
+        changed += [(t, item) for item in result]
+    changed_ids = {(t, item.get('id')) for t, item in changed}
+
+    def merged():
+        for t, item in base.serials.records():
+            if (t, item.get('id')) not in changed_ids:
+                yield t, item
+        yield from changed
+
+    with timed('index.serials_build'):
+        new_serial = await asyncio.get_running_loop().run_in_executor(None, SerialIndex.build, merged())
+    new_entity['Contact'] = {c for c in new_serial.column('contact') if c} if 'contact' in new_serial.columns \
+        else set(base.entities.get('Contact', ()))
+    for entity, ok in zip(entity_names, await asyncio.gather(*entity_tasks)):
+        if not ok and entity in base.entities:
+            new_entity[entity] = base.entities[entity]  # недогруженный справочник берём из прежнего поколения
+        failed = failed or not ok
+    if source != base_url:
+        app.log("Сервер сменился во время индексации, результат отброшен")
+        return
+    snapshot = await asyncio.get_running_loop().run_in_executor(None, publish_index, new_serial, new_entity,
+                                                                 None, source)
+    app.log(f"Дельта-индексация завершена: изменено позиций {len(changed)}, поколение индекса {snapshot.generation}")
+    await record_changes(app, base, snapshot)
+    if not failed:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, save_index_cache, snapshot)
+        except (OSError, TypeError, ValueError) as e:
+            app.log(f"Ошибка сохранения индекса на диск: {e}")
+
+
+# Лента изменений: при каждой синхронизации новое поколение сравнивается с предыдущим,
+# и различия по полям дописываются в файл дня (changes/<сервер>_<дата>.jsonl)
+CHANGE_NAMES = {'added': "Добавлено", 'changed': "Изменено", 'removed': "Удалено"}
+CHANGES_SHOWN = 2000
+
+
+def display_value(snapshot, field, value):
+    entity = INDEXED_FIELDS.get(field)
+    if entity and entity != 'Contact' and value:
+        value = snapshot.entities.get(entity, {}).get(str(value), value)
+        return trim_location(value) if entity == 'Location' and isinstance(value, str) else value
+    return value
+
+
+def diff_generations(old, new):
+    # Позиции сопоставляются по (тип, id); строки с одинаковым хэшем содержимого не разбираются
+    def positions(serials):
+        ids = serials.column('id')
+        return {(serials.types[code], ids[row]): row for row, code in enumerate(serials.type_codes)}
+
+    before, after = positions(old.serials), positions(new.serials)
+    columns = [c for c in new.serials.columns if c in old.serials.columns and c not in ('id', 'date_mod')]
+    now, changes = time.time(), []
+
+    def entry(change, key, item, fields=None):
+        return {'generation': new.generation, 'time': now, 'change': change, 'type': key[0], 'id': key[1],
+                'serial': item_serial(item), 'name': item.get('name', ''), 'fields': fields or {}}
+
+    for key, row in after.items():
+        old_row = before.pop(key, None)
+        if old_row is None:
+            changes.append(entry('added', key, new.serials.item(row)[1]))
+        elif old.serials.hashes[old_row] != new.serials.hashes[row]:
+            old_item, new_item = old.serials.item(old_row)[1], new.serials.item(row)[1]
+            fields = {c: [display_value(old, c, old_item.get(c)), display_value(new, c, new_item.get(c))]
+                      for c in columns if old_item.get(c) != new_item.get(c)}
+            if fields:
+                changes.append(entry('changed', key, new_item, fields))
+    changes += [entry('removed', key, old.serials.item(row)[1]) for key, row in before.items()]
+    return changes
+
+
+def changes_path(day, url=None):
+    return os.path.join(CHANGES_DIR, f'{server_key(url)}_{day}.jsonl')
+
+
+def save_changes(changes):
+    os.makedirs(CHANGES_DIR, exist_ok=True)
+    with open(changes_path(time.strftime('%Y-%m-%d')), 'a', encoding='utf-8') as f:
+        for change in changes:
+            f.write(json.dumps(change, ensure_ascii=False) + '\n')
 
 
-def run_async_index(app):
-    asyncio.run(index_data_async(app))
+def change_days():
+    # Дни, за которые по текущему серверу есть изменения, от новых к старым
+    prefix = f'{server_key()}_'
+    if not os.path.isdir(CHANGES_DIR):
+        return []
+    return sorted((name[len(prefix):-len('.jsonl')] for name in os.listdir(CHANGES_DIR)
+                   if name.startswith(prefix) and name.endswith('.jsonl')), reverse=True)
+
+
+def read_changes(day):
+    changes = []
+    try:
+        with open(changes_path(day), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    changes.append(json.loads(line))
+                except ValueError:
+                    continue  # недописанная строка при аварийном завершении
+    except OSError as e:
+        print(f"Ошибка чтения ленты изменений: {e}")
+    return changes
+
+
+async def record_changes(app, old, new):
+    if not old.serials or old.source != new.source:
+        return  # первое поколение или другой сервер - сравнивать не с чем
+    loop = asyncio.get_running_loop()
+    with timed('index.changes'):
+        changes = await loop.run_in_executor(None, diff_generations, old, new)
+    if not changes:
+        return
+    counts = {c: sum(1 for e in changes if e['change'] == c) for c in ('added', 'changed', 'removed')}
+    app.log(f"Изменения с прошлой синхронизации: добавлено {counts['added']}, изменено {counts['changed']}, "
+            f"удалено {counts['removed']}")
+    try:
+        await loop.run_in_executor(None, save_changes, changes)
+    except OSError as e:
+        app.log(f"Ошибка записи ленты изменений: {e}")
+
+
+def publish_index(new_serial, new_entity, built_at=None, source=None):
+    # Обратные индексы и дерево местоположений строятся до захвата блокировки: из цикла asyncio
+    # функция вызывается через run_in_executor, чтобы полный проход по парку не останавливал запросы
+    global index_snapshot
+    snapshot = IndexSnapshot(0, built_at or time.time(), new_serial, new_entity, source or base_url)
+    with index_publish_lock:
+        snapshot.generation = index_snapshot.generation + 1
+        index_snapshot = snapshot
+    return snapshot
+
+
+def drop_foreign_index(url):
+    # При входе на другой сервер поколение прежнего сразу убирается: ни поиск, ни подсказки,
+    # ни офлайн-режим не должны видеть чужие данные, пока строится или читается с диска своё
+    global index_snapshot
+    with index_publish_lock:
+        if index_snapshot.source != url:
+            index_snapshot = IndexSnapshot(index_snapshot.generation + 1, 0.0, {}, {}, url)
+
+
+# Последнее полностью построенное поколение индекса хранится на диске, отдельно для каждого сервера:
+# с него начинается работа после входа, по нему же идёт поиск в офлайн-режиме
+def server_key(url=None):
+    return hashlib.sha1((url or base_url).encode('utf-8')).hexdigest()[:16]
+
+
+def index_cache_path(url=None):
+    return os.path.join(INDEX_CACHE_DIR, f'index_{server_key(url)}.json')
+
+
+def save_index_cache(snapshot):
+    serials = snapshot.serials
+    data = {'version': 2, 'base_url': snapshot.source, 'built_at': snapshot.built_at,
+            'columns': serials.columns, 'types': serials.types,
+            'type_codes': serials.type_codes.tolist(), 'rows': serials.rows,
+            'entities': {k: sorted(v) if isinstance(v, frozenset) else dict(v)
+                         for k, v in snapshot.entities.items()}}
+    path = index_cache_path(data['base_url'])
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    with timed('index.cache_save'):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+
+def read_index_cache(url=None):
+    # Возвращает (serials, entities, built_at) без публикации; None, если сохранённого индекса нет
+    path = index_cache_path(url)
+    if not os.path.exists(path):
+        return None
+    try:
+        with timed('index.cache_load'):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения сохранённого индекса: {e}")
+        return None
+    if data.get('version') != 2:
+        return None  # формат до компактного индекса - индекс будет построен заново
+    columns, types = data['columns'], data['types']
+    serials = SerialIndex.build((types[code], dict(zip(columns, row)))
+                                for code, row in zip(data['type_codes'], data['rows']))
+    entities = {k: set(v) if isinstance(v, list) else v for k, v in data.get('entities', {}).items()}
+    return serials, entities, data.get('built_at')
+
+
+def load_index_cache():
+    cached = read_index_cache()
+    return publish_index(*cached) if cached else None
+
+
+def run_async_index(app, delta=False):
+    # Одновременно строится только одно поколение индекса; сама индексация идёт в общем цикле asyncio
+    if not index_build_lock.acquire(blocking=False):
+        app.log("Индексация уже выполняется, запуск пропущен")
+        return
+
+    def done(future):
+        index_build_lock.release()
+        if not future.cancelled() and future.exception():
+            app.log(f"Ошибка индексации: {future.exception()}")
+        elif use_indexing:
+            # Поисковые индексы пользователей и похожих номеров готовятся заранее, а не при первом поиске
+            app.lookup_pool.submit(app.user_index)
+            app.lookup_pool.submit(app.fuzzy_index)
+
+    async_service.submit(delta_index_async(app) if delta else index_data_async(app)).add_done_callback(done)
+
+
+# Сравнение двух экземпляров GLPI из auth_history (например, рабочего и проверочного).
+# Оба индексируются одновременно в общем цикле asyncio, каждый через свою сессию,
+# затем отсортированные по инв. номеру записи сравниваются одним проходом слиянием
+def record_values(t, item, entities):
+    # Значения полей field_mappings в том виде, как их видит пользователь: ссылки на справочники
+    # заменены названиями, поэтому записи разных серверов сравнимы и при разных id
+    values = []
+    for field in field_mappings.values():
+        value = t if field == 'type' else item.get(field)
+        if field in INDEXED_FIELDS and INDEXED_FIELDS[field] != 'Contact' and value:
+            value = entities.get(INDEXED_FIELDS[field], {}).get(str(value), value)
+        values.append('' if value is None else str(value))
+    return tuple(values)
+
+
+def keyed_records(records, entities):
+    # [(номер, хэш, значения)] по возрастанию номера; при повторе номера побеждает последняя запись
+    keyed = {}
+    for t, item in records:
+        if key := item_serial(item):
+            values = record_values(t, item, entities)
+            keyed[key] = (key, record_hash(values), values)
+    return sorted(keyed.values())
+
+
+def diff_instances(left, right):
+    # Выдаёт ('removed' | 'added' | 'changed', номер, значения слева, значения справа)
+    left, right = iter(left), iter(right)
+    a, b = next(left, None), next(right, None)
+    while a or b:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield 'removed', a[0], a[2], None
+            a = next(left, None)
+        elif a is None or b[0] < a[0]:
+            yield 'added', b[0], None, b[2]
+            b = next(right, None)
+        else:
+            if a[1] != b[1]:
+                yield 'changed', a[0], a[2], b[2]
+            a, b = next(left, None), next(right, None)
+
+
+def preset_name(preset):
+    return preset.get('name', f"{preset['base_url']} - {preset['user_token'][:8]}...")
+
+
+async def index_instance(app, preset):
+    # Текущий сервер читается через основную сессию; для другого открывается своя,
+    # которая задаётся только этой задаче и закрывается по окончании
+    name = preset_name(preset)
+    if preset['base_url'] == base_url:
+        records, entities, failed = await collect_index(app)
+    else:
+        glpi_connection.set((preset['base_url'], {
+            'App-Token': preset.get('app_token', ''), 'Authorization': f"user_token {preset.get('user_token', '')}",
+            'Content-Type': 'application/json'}))
+        data = await glpi_request_async('GET', 'initSession', timeout=10)
+        if not isinstance(data, dict) or 'session_token' not in data:
+            raise GLPIError(f"{name}: некорректный ответ initSession {data}")
+        current_connection()[1]['Session-Token'] = data['session_token']
+        try:
+            records, entities, failed = await collect_index(app)
+        finally:
+            try:
+                await glpi_request_async('GET', 'killSession', timeout=5)
+            except GLPIError as e:
+                app.log(f"{name}: не удалось закрыть сессию: {e}")
+    if failed:
+        raise GLPIError(f"{name}: индексация завершилась с ошибками")
+    app.log(f"{name}: загружено позиций {len(records)}")
+    return await asyncio.get_running_loop().run_in_executor(None, keyed_records, records, entities)
+
+
+async def compare_instances(app, left, right, file_path):
+    tasks = [asyncio.create_task(index_instance(app, preset)) for preset in (left, right)]
+    with timed('compare.index'):
+        try:
+            left_records, right_records = await asyncio.gather(*tasks)
+        except BaseException:
+            # Без одного из серверов сравнивать нечего: второй отменяется, его сессия закрывается в finally
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    return await asyncio.get_running_loop().run_in_executor(
+        None, write_compare_report, file_path, preset_name(left), preset_name(right), left_records, right_records)
+
+
+def write_compare_report(file_path, left_name, right_name, left, right):
+    # Различия пишутся по мере слияния: по строке на каждое изменённое поле,
+    # по строке на позицию, которая есть только в одном экземпляре. Возвращает счётчики
+    statuses = {'removed': f"Только в {left_name}", 'added': f"Только в {right_name}", 'changed': "Изменено"}
+    fields = list(field_mappings)
+    summary_columns = [k for k, field in enumerate(field_mappings.values()) if field in ('type', 'name')]
+    counts = dict.fromkeys(statuses, 0)
+
+    def rows():
+        yield ["Изменение", "Инв. номер", "Поле", left_name, right_name]
+        for status, key, a, b in diff_instances(left, right):
+            counts[status] += 1
+            if status == 'changed':
+                for field, old, new in zip(fields, a, b):
+                    if old != new:
+                        yield [statuses[status], key, field, old, new]
+            else:
+                values = a or b
+                summary = ' '.join(values[k] for k in summary_columns if values[k])
+                yield [statuses[status], key, '', summary if a else '', '' if a else summary]
+
+    with timed('compare.report'):
+        if file_path.lower().endswith('.xlsx'):
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Сравнение")
+            for row in rows():
+                ws.append(row)
+            wb.save(file_path)
+        else:
+            with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                csv.writer(f, delimiter=';').writerows(rows())
+    return counts
+
+
+REPORT_CHUNK_ROWS = 5000
+ARROW_CHUNK_ROWS = 50000
+
+
+def chunked(iterable, size):
+    chunk = []
+    for value in iterable:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def expanded_name(value):
+    # Ссылка на справочник из ответа с expand_dropdowns: пустая приходит как 0, '' или '&nbsp;'
+    return 'Не указано' if value in (None, 0, '0', '', '&nbsp;') else str(value)
+
+
+def report_row(serial, item_type, item, entities, details=None):
+    # Значения столбцов field_mappings для выгрузок: ссылки на справочники - названиями из индекса,
+    # без индекса - из полной записи details (getMultipleItems), если она загружена
+    row = []
+    for glpi_field in field_mappings.values():
+        entity = INDEXED_FIELDS.get(glpi_field)
+        if glpi_field == 'type':
+            value = TYPE_NAMES.get(item_type, item_type)
+        elif glpi_field == 'otherserial':
+            value = serial
+        elif entity and entity != 'Contact' and use_indexing and entity in entities:
+            value = entities[entity].get(str(item.get(glpi_field)), 'Не указано')
+            if entity == 'Location':
+                value = trim_location(value)
+        elif entity and entity != 'Contact' and details is not None:
+            value = expanded_name(details.get(glpi_field))
+            if entity == 'Location':
+                value = trim_location(value)
+        else:
+            value = item.get(glpi_field, details.get(glpi_field, 'Не указано') if details else 'Не указано')
+        row.append(value)
+    return row
+
+
+def stream_report(file_path, records, entities, progress=None):
+    # Пишет позиции (тип, запись) из индекса в CSV или XLSX порциями по REPORT_CHUNK_ROWS строк,
+    # не собирая отчёт в памяти целиком; progress(n) вызывается после каждой порции
+    def chunks():
+        return chunked((report_row(item_serial(item), t, item, entities) for t, item in records), REPORT_CHUNK_ROWS)
+
+    written = 0
+    with timed('export.report') as span:
+        if file_path.lower().endswith('.xlsx'):
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Отчёт")
+            ws.append(list(field_mappings))
+            for chunk in chunks():
+                for row in chunk:
+                    ws.append(row)
+                written += len(chunk)
+                if progress:
+                    progress(written)
+            wb.save(file_path)
+        else:
+            with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                writer = csv.writer(f, delimiter=';')
+                writer.writerow(list(field_mappings))
+                for chunk in chunks():
+                    writer.writerows(chunk)
+                    written += len(chunk)
+                    if progress:
+                        progress(written)
+        span['bytes'] = os.path.getsize(file_path)
+    return written
+
+
+class ArrowDictionary:
+    # Словарь строкового столбца, который растёт от порции к порции: коды уже записанных значений
+    # не меняются, поэтому в файл Arrow уходят только добавки словаря (delta)
+    def __init__(self):
+        self.lookup, self.values = {}, []
+
+    def encode(self, values):
+        codes = []
+        for value in values:
+            code = self.lookup.get(value)
+            if code is None and value is not None:
+                code = self.lookup[value] = len(self.values)
+                self.values.append(value)
+            codes.append(code)
+        return pa.DictionaryArray.from_arrays(pa.array(codes, pa.int32()), pa.array(self.values, pa.string()))
+
+
+def arrow_columns(entities):
+    # [(имя, тип Arrow, значение по (тип, запись))]: id и ссылки на справочники - целые числа,
+    # рядом названия из справочников; тип, названия и стеллаж - словарные строки, date_mod - время
+    text = pa.dictionary(pa.int32(), pa.string())
+
+    def integer(field):
+        def value(t, item):
+            try:
+                return int(item.get(field)) or None  # 0 в GLPI - пустая ссылка
+            except (TypeError, ValueError):
+                return None
+        return value
+
+    def string(field):
+        return lambda t, item: None if item.get(field) in (None, '') else str(item.get(field))
+
+    columns = [('type', text, lambda t, item: t), ('id', pa.int64(), integer('id'))]
+    for field in dict.fromkeys(SerialIndex.BASE_COLUMNS + tuple(field_mappings.values())):
+        entity = INDEXED_FIELDS.get(field)
+        if field in ('type', 'id'):
+            continue
+        if entity and entity != 'Contact':
+            names = entities.get(entity, {})
+            columns.append((field, pa.int64(), integer(field)))
+            columns.append((f'{field}_name', text, lambda t, item, f=field, n=names: n.get(str(item.get(f)))))
+        elif field == 'date_mod':
+            columns.append((field, pa.timestamp('s'), string(field)))
+        else:
+            columns.append((field, text if entity else pa.string(), string(field)))
+    return columns
+
+
+def write_arrow(file_path, records, entities, metadata=None, progress=None):
+    # Parquet (.parquet, сжатие zstd) или файл Arrow IPC (.arrow) порциями по ARROW_CHUNK_ROWS строк
+    columns = arrow_columns(entities)
+    schema = pa.schema([pa.field(name, kind) for name, kind, _ in columns],
+                       metadata={k: str(v) for k, v in (metadata or {}).items()})
+    dictionaries = {name: ArrowDictionary() for name, kind, _ in columns if pa.types.is_dictionary(kind)}
+
+    def batch(chunk):
+        arrays = []
+        for name, kind, value in columns:
+            values = [value(t, item) for t, item in chunk]
+            if name in dictionaries:
+                arrays.append(dictionaries[name].encode(values))
+            elif pa.types.is_timestamp(kind):
+                arrays.append(pc.strptime(pa.array(values, pa.string()), format='%Y-%m-%d %H:%M:%S', unit='s',
+                                          error_is_null=True))
+            else:
+                arrays.append(pa.array(values, kind))
+        return pa.record_batch(arrays, schema=schema)
+
+    written = 0
+    with timed('export.arrow') as span:
+        if file_path.lower().endswith('.parquet'):
+            writer = pq.ParquetWriter(file_path, schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(file_path, schema, options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+        with writer:
+            for chunk in chunked(records, ARROW_CHUNK_ROWS):
+                writer.write_batch(batch(chunk))
+                written += len(chunk)
+                if progress:
+                    progress(written)
+        span['bytes'] = os.path.getsize(file_path)
+    return written
+
+
+USER_NAME_RE = re.compile(r'^[А-Яа-я\s]+$')
+FUZZY_LIMIT = 10
+
+
+def edit_distance(a, b):
+    # Дамерау-Левенштейн (с перестановкой соседних символов - частая ошибка ручного ввода);
+    # общие начало и конец, обычные у инвентарных номеров, отбрасываются до расчёта
+    while a and b and a[0] == b[0]:
+        a, b = a[1:], b[1:]
+    while a and b and a[-1] == b[-1]:
+        a, b = a[:-1], b[:-1]
+    if len(a) < len(b):
+        a, b = b, a
+    before, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                value = min(value, before[j - 2] + 1)
+            current.append(value)
+        before, previous = previous, current
+    return previous[-1]
+
+
+# Индекс похожих номеров по схеме симметричного удаления: для каждого номера хранятся хэши
+# его самого и всех вариантов без одного символа. У номеров, отличающихся одной заменой,
+# вставкой, удалением или перестановкой соседних символов, есть общий вариант, поэтому поиск -
+# это несколько bisect по одному массиву, без перебора индекса. Хэш и строка индекса упакованы
+# в одно 64-битное число; совпадения хэшей проверяются точным расстоянием
+class FuzzyIndex:
+    ROW_BITS = 24
+
+    def __init__(self, key_rows):
+        mask = (1 << (64 - self.ROW_BITS)) - 1
+        self.mask = mask
+        self.entries = array('Q', sorted((hash(variant) & mask) << self.ROW_BITS | row
+                                         for key, row in key_rows for variant in self.variants(key)))
+
+    @staticmethod
+    def variants(key):
+        return {key} | {key[:i] + key[i + 1:] for i in range(len(key))}
+
+    def candidates(self, key):
+        rows = set()
+        for variant in self.variants(key):
+            low = (hash(variant) & self.mask) << self.ROW_BITS
+            i = bisect.bisect_left(self.entries, low)
+            while i < len(self.entries) and self.entries[i] >> self.ROW_BITS == low >> self.ROW_BITS:
+                rows.add(self.entries[i] & ((1 << self.ROW_BITS) - 1))
+                i += 1
+        return rows
+
+
+def short_location(location):
+    if len(location) > 30 and '>' in location:
+        parts = location.split('>')
+        return f"{parts[0].strip()}>...>{parts[-1].strip()}"
+    return location[:37] + '...' if len(location) > 40 else location
+
+
+# Каталог значений выпадающих списков на одно поколение индекса: отсортированные списки
+# для панелей изменения и фильтров и обратное соответствие "отображаемое значение -> id".
+# Таблицы, которых нет в индексе, загружаются через loader один раз на каталог
+class DropdownCatalog:
+    def __init__(self, tables, loader):
+        self.tables = dict(tables)
+        self.loader = loader
+        self.lists = {}
+        self.ids = {}
+
+    def table(self, entity):
+        if entity not in self.tables:
+            self.tables[entity] = self.loader(entity)
+        return self.tables[entity]
+
+    def _build(self, entity):
+        table = self.table(entity)
+        if entity == 'Contact':
+            ordered = sorted(table, key=str.lower)
+            self.lists[entity] = (ordered, ordered)
+            self.ids[entity] = {}
+            return
+        valid = [(k, v) for k, v in table.items() if isinstance(v, str) and v != 'Не указано']
+        ids = {}
+        if entity == 'Location':
+            filter_values, edit_values = [], []
+            for k, v in valid:
+                trimmed = trim_location(v)
+                shortened = short_location(trimmed)
+                # Если сокращённые пути совпали, второй показываем полностью
+                if shortened in ids and ids[shortened] != k:
+                    shortened = trimmed
+                ids.setdefault(shortened, k)
+                ids.setdefault(trimmed, k)
+                filter_values.append(trimmed)
+                edit_values.append(shortened)
+        else:
+            for k, v in valid:
+                ids.setdefault(v, k)
+            filter_values = edit_values = [v for _, v in valid]
+        self.lists[entity] = (sorted(edit_values, key=str.lower), sorted(filter_values, key=str.lower))
+        self.ids[entity] = ids
+
+    def edit_choices(self, entity):
+        if entity not in self.lists:
+            self._build(entity)
+        return self.lists[entity][0]
+
+    def filter_choices(self, entity):
+        if entity not in self.lists:
+            self._build(entity)
+        return self.lists[entity][1]
+
+    def lookup_id(self, entity, display):
+        if entity not in self.ids:
+            self._build(entity)
+        found = self.ids[entity].get(display)
+        if found is None and display.endswith('...'):
+            # Обрезанное значение: ищем по префиксу, как раньше
+            prefix = display[:-3]
+            found = next((k for k, v in self.ids[entity].items() if k.startswith(prefix)), None)
+            found = self.ids[entity][found] if found is not None else None
+        return found
+
+
+# Поисковый индекс пользователей: ключи приводятся к нижнему регистру один раз,
+# короткие запросы ищутся по префиксу через bisect, длинные - по триграммам
+class UserSearchIndex:
+    def __init__(self, names):
+        self.names = sorted(set(names), key=str.lower)
+        self.lowered = [n.lower() for n in self.names]
+        self.trigrams = {}
+        for idx, name in enumerate(self.lowered):
+            for gram in {name[k:k + 3] for k in range(len(name) - 2)}:
+                self.trigrams.setdefault(gram, []).append(idx)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, limit):
+        q = query.strip().lower()
+        if not q:
+            return self.names[:limit]
+        result, seen = [], set()
+        # Сначала имена, начинающиеся с запроса (по алфавиту)
+        pos = bisect.bisect_left(self.lowered, q)
+        while pos < len(self.lowered) and self.lowered[pos].startswith(q) and len(result) < limit:
+            result.append(self.names[pos])
+            seen.add(pos)
+            pos += 1
+        if len(result) >= limit:
+            return result
+        # Затем остальные вхождения подстроки
+        if len(q) >= 3:
+            postings = [self.trigrams.get(q[k:k + 3], ()) for k in range(len(q) - 2)]
+            candidates = min(postings, key=len)
+        else:
+            candidates = range(len(self.lowered))
+        for idx in candidates:
+            if idx not in seen and q in self.lowered[idx]:
+                result.append(self.names[idx])
+                if len(result) >= limit:
+                    break
+        return result
+
+
+# Список выбора пользователя: кнопки создаются один раз и переиспользуются,
+# поиск запускается с задержкой после последнего нажатия клавиши
+class UserPicker:
+    DEBOUNCE_MS = 150
+
+    def __init__(self, list_frame, search_entry, selected_var, index, limit, pinned=()):
+        self.list_frame = list_frame
+        self.search_entry = search_entry
+        self.selected_var = selected_var
+        self.index = index
+        self.limit = limit
+        self.pinned = list(pinned)
+        self.pending = None
+        self.label = ctk.CTkLabel(list_frame, textvariable=selected_var, font=("Arial", scaled_font(12)),
+                                  text_color="white")
+        self.label.pack(pady=5)
+        self.empty_label = ctk.CTkLabel(list_frame, text="Нет совпадений", font=("Arial", scaled_font(12)),
+                                        text_color="white")
+        self.buttons = []
+        for _ in range(limit):
+            button = ctk.CTkButton(list_frame, text="", font=("Arial", scaled_font(12)), width=280)
+            button.configure(command=lambda b=button: self.selected_var.set(b.cget("text")))
+            self.buttons.append(button)
+        self.shown = 0
+        search_entry.bind("<KeyRelease>", self._schedule)
+        self.refresh()
+
+    def _schedule(self, event=None):
+        if self.pending is not None:
+            self.list_frame.after_cancel(self.pending)
+        self.pending = self.list_frame.after(self.DEBOUNCE_MS, self.refresh)
+
+    def refresh(self):
+        self.pending = None
+        if not self.list_frame.winfo_exists():
+            return
+        query = self.search_entry.get()
+        with timed('users.search'):
+            pinned = [p for p in self.pinned if query.strip().lower() in p.lower()]
+            matches = (pinned + self.index.search(query, self.limit))[:self.limit]
+        self.empty_label.pack_forget()
+        for k, button in enumerate(self.buttons):
+            if k < len(matches):
+                button.configure(text=matches[k])
+                if k >= self.shown:
+                    button.pack(pady=2)
+            elif k < self.shown:
+                button.pack_forget()
+        self.shown = len(matches)
+        if not matches:
+            self.empty_label.pack(pady=5)
+
+
+def item_serial(item):
+    return str(item.get('otherserial') or item.get('serial') or '').lstrip('0')
+
+
+# Сессия инвентаризации: ожидаемый состав стеллажа, местоположения или департамента берётся
+# из индекса один раз, каждое сканирование - операции над множествами за O(1), без запросов к GLPI
+class AuditSession:
+    def __init__(self, title, items):
+        self.title = title
+        self.started = time.time()
+        self.expected = {(t, item.get('id')): item_serial(item) for t, item in items}
+        self.found = set()
+        self.unexpected = {}  # (тип, id) -> номер позиции, которой по индексу здесь быть не должно
+
+    def scan(self, t, item):
+        key = (t, item.get('id'))
+        if key in self.expected:
+            if key in self.found:
+                return 'repeat'
+            self.found.add(key)
+            return 'found'
+        if key in self.unexpected:
+            return 'repeat'
+        self.unexpected[key] = item_serial(item)
+        return 'unexpected'
+
+    def unscan(self, t, item):
+        key = (t, item.get('id'))
+        self.found.discard(key)
+        self.unexpected.pop(key, None)
+
+    def counts(self):
+        # (ожидается, найдено, недостаёт, лишних)
+        return len(self.expected), len(self.found), len(self.expected) - len(self.found), len(self.unexpected)
+
+    def missing(self):
+        return [(key, s) for key, s in self.expected.items() if key not in self.found]
 
 
 class GLPIApp:
@@ -234,8 +1902,27 @@ class GLPIApp:
         self.change_log, self.found_items, self.pending_serials = [], {}, set()
         self.extended_frame = None
         self.buffer_items = {}
+        self.refresh_job = None
+        # Офлайн-режим: поиск по сохранённому индексу, изменения копятся в журналах-очереди
+        self.offline, self.offline_auto, self.offline_job = False, False, None
+        self.active_journals = set()
+        self.audit = None
+        # Полные записи позиций буфера с названиями вместо ссылок: (тип, id) -> запись getMultipleItems
+        self.item_details = {}
+        self.prefetch_job, self.prefetch_running = None, False
+        # Растёт при изменении позиций и очистке буфера: ответы загрузок, начатых раньше, отбрасываются
+        self.details_generation = 0
+        self.user_index_cache = (None, None)
+        self.catalog_cache = (None, None)
+        self.fuzzy_cache = (None, None, None)
+        self.fuzzy_lock = threading.Lock()
+        self.stats_cache = (None, None)
+        # Все изменения виджетов из рабочих потоков идут через эту очередь и выполняются в цикле Tk
+        self.ui_queue = queue.Queue()
+        self.lookup_pool = ThreadPoolExecutor(max_workers=lookup_workers, thread_name_prefix='lookup')
         self.setup_ui()
         self.root.bind("<F11>", lambda e: self.root.state('zoomed'))
+        self._drain_ui_queue()
 
     def setup_ui(self):
         self.main_frame = ctk.CTkFrame(self.root, corner_radius=0, fg_color="#2d2d2d")
@@ -263,6 +1950,11 @@ class GLPIApp:
         self.found_count_label = ctk.CTkLabel(counter_frame, text="Найдено: 0", font=("Arial", scaled_font(12)),
                                               text_color="white")
         self.found_count_label.pack(anchor='w')
+        self.mode_label = ctk.CTkLabel(counter_frame, text="", font=("Arial", scaled_font(12)), text_color="#ffaa00")
+        self.audit_label = ctk.CTkLabel(counter_frame, text="", font=("Arial", scaled_font(12)), text_color="#66ccff")
+        self.offline_var = tk.BooleanVar(value=False)
+        ctk.CTkSwitch(input_frame, text="Офлайн", variable=self.offline_var, font=("Arial", scaled_font(12)),
+                      command=lambda: self.set_offline(self.offline_var.get())).pack(side='left', padx=5)
 
         self.buffer_frame = ctk.CTkFrame(self.left_frame, corner_radius=10, fg_color="#2d2d2d")
         self.buffer_frame.pack(pady=10, fill='both', expand=True)
@@ -292,6 +1984,12 @@ class GLPIApp:
                                                                                                           padx=5)
         ctk.CTkButton(button_frame, text="Настройки", command=self.settings_window,
                       font=("Arial", scaled_font(12))).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Аудит", command=self.audit_window,
+                      font=("Arial", scaled_font(12))).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Изменения", command=self.changes_window,
+                      font=("Arial", scaled_font(12))).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Статистика", command=self.stats_window,
+                      font=("Arial", scaled_font(12))).pack(side='left', padx=5)
         # Добавляем кнопку Импорт/Экспорт
         ctk.CTkButton(button_frame, text="Импорт/Экспорт", command=self.import_export_window,
                       font=("Arial", scaled_font(12))).pack(side='left', padx=5)
@@ -311,12 +2009,207 @@ class GLPIApp:
     def _on_mousewheel(self, event):
         self.buffer_canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
 
+    def ui(self, func, *args):
+        if threading.current_thread() is threading.main_thread():
+            func(*args)
+        else:
+            self.ui_queue.put((func, args))
+
+    def _drain_ui_queue(self):
+        deadline = time.perf_counter() + 0.05  # не занимаем цикл Tk дольше 50 мс за раз
+        while time.perf_counter() < deadline:
+            try:
+                func, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Ошибка обновления интерфейса ({getattr(func, '__name__', func)}): {e}")
+        self.root.after(20, self._drain_ui_queue)
+
     def log(self, msg):
-        if show_logs:
-            self.log_text.insert('end', f"[{time.strftime('%H:%M:%S')}] {msg}\n")
-            self.log_text.see('end')
         if debug_mode:
             print(f"DEBUG: {msg}")
+        self.ui(self._append_log, f"[{time.strftime('%H:%M:%S')}] {msg}\n")
+
+    def _append_log(self, line):
+        if show_logs:
+            self.log_text.insert('end', line)
+            self.log_text.see('end')
+
+    def schedule_index_refresh(self):
+        if self.refresh_job:
+            self.root.after_cancel(self.refresh_job)
+            self.refresh_job = None
+        if index_refresh_minutes > 0:
+            self.refresh_job = self.root.after(index_refresh_minutes * 60000, self._periodic_index_refresh)
+
+    def _periodic_index_refresh(self):
+        self.refresh_job = None
+        if use_indexing and 'Session-Token' in headers and not self.offline:
+            run_async_index(self)
+            self.log("Плановое обновление индекса запущено")
+        self.schedule_index_refresh()
+
+    def set_offline(self, offline, reason='', probed=False):
+        # auto - режим включён из-за потери связи: тогда связь периодически проверяется
+        # и при её появлении приложение само возвращается в онлайн.
+        # probed - сессия с сервером уже проверена; без этого выход из офлайна начинается с проверки
+        auto = bool(reason)
+        if offline == self.offline:
+            self.offline_auto = self.offline_auto and auto
+            return
+        if not offline and not probed:
+            self.offline_var.set(True)
+            self.log("Проверка связи с GLPI перед выходом из офлайн-режима...")
+
+            def done(future):
+                if future.exception() is None:
+                    self.ui(self.set_offline, False, '', True)
+                else:
+                    self.log(f"Связи с GLPI нет, работа продолжается офлайн: {future.exception()}")
+
+            async_service.submit(self._open_session()).add_done_callback(done)
+            return
+        if offline and not (index_snapshot.serials and index_snapshot.source == base_url) \
+                and not load_index_cache():
+            self.offline_var.set(False)
+            self.log("Офлайн-режим недоступен: нет сохранённого индекса для этого сервера")
+            return
+        self.offline, self.offline_auto = offline, offline and auto
+        self.offline_var.set(offline)
+        if self.offline_job:
+            self.root.after_cancel(self.offline_job)
+            self.offline_job = None
+        if offline:
+            built = time.strftime('%d.%m.%Y %H:%M', time.localtime(index_snapshot.built_at))
+            self.mode_label.configure(text=f"Офлайн, индекс от {built}")
+            self.mode_label.pack(anchor='w')
+            self.log(f"Офлайн-режим{' (' + reason + ')' if reason else ''}: поиск по индексу от {built}, "
+                     f"изменения ставятся в очередь")
+            if self.offline_auto:
+                self.offline_job = self.root.after(OFFLINE_PROBE_SECONDS * 1000, self._probe_connection)
+        else:
+            self.mode_label.pack_forget()
+            self.log("Онлайн-режим: отправка накопленных изменений")
+            if use_indexing and 'Session-Token' in headers:
+                run_async_index(self)
+            self.sync_outbox()
+
+    def _probe_connection(self):
+        self.offline_job = None
+        if not self.offline_auto:
+            return
+
+        def done(future):
+            if future.exception() is None:
+                self.ui(self.set_offline, False, '', True)
+            else:
+                self.ui(self._reschedule_probe)
+
+        async_service.submit(self._open_session()).add_done_callback(done)
+
+    @staticmethod
+    async def _open_session():
+        # Без действующей сессии онлайн-режим бессмыслен: все запросы и очередь изменений получат 401
+        if 'Session-Token' in headers:
+            await glpi_request_async('GET', 'getFullSession', timeout=5)
+        else:
+            # Работа была начата без связи - сессия создаётся при первом успешном ответе
+            data = await glpi_request_async('GET', 'initSession', timeout=5)
+            if not isinstance(data, dict) or 'session_token' not in data:
+                raise GLPIError(f"Некорректный ответ initSession: {data}")
+            headers['Session-Token'] = data['session_token']
+
+    def _reschedule_probe(self):
+        if self.offline_auto and not self.offline_job:
+            self.offline_job = self.root.after(OFFLINE_PROBE_SECONDS * 1000, self._probe_connection)
+
+    def sync_outbox(self):
+        for journal in UpdateJournal.unfinished(self.active_journals):
+            if journal.header.get('queued'):
+                self.resume_journal(journal)
+
+    def user_index(self):
+        # Индекс пользователей строится один раз на поколение индекса,
+        # без индексации - один раз на загрузку списка (не чаще раза в 10 минут)
+        snapshot = index_snapshot
+        if use_indexing and 'User' in snapshot.entities:
+            key = ('index', snapshot.generation)
+        else:
+            key = ('download', int(time.time() // 600))
+        cached_key, cached_index = self.user_index_cache
+        perf.cache('user_search_index', cached_key == key)
+        if cached_key == key:
+            return cached_index
+        if key[0] == 'index':
+            names = [x for x in snapshot.entities['User'].values() if
+                     isinstance(x, str) and x != 'Не указано' and USER_NAME_RE.match(x)]
+        else:
+            try:
+                data = glpi_request('GET', 'User', params={'range': '0-9999'})
+                names = [n for n in (f"{i.get('realname', '')} {i.get('firstname', '')}".strip() for i in data) if
+                         n and USER_NAME_RE.match(n)]
+            except GLPIError as e:
+                self.log(f"Ошибка загрузки пользователей: {e}")
+                return UserSearchIndex(['Не указано'])
+        with timed('users.index_build'):
+            index = UserSearchIndex(names)
+        self.user_index_cache = (key, index)
+        return index
+
+    def fuzzy_index(self, wait=True):
+        # Индекс похожих номеров строится один раз на поколение; (номера индекса, FuzzyIndex) или None,
+        # если он сейчас строится другим потоком, а ждать не нужно
+        if not self.fuzzy_lock.acquire(blocking=wait):
+            return None
+        try:
+            snapshot = index_snapshot
+            generation, serials, tree = self.fuzzy_cache
+            perf.cache('fuzzy_index', generation == snapshot.generation)
+            if generation != snapshot.generation:
+                with timed('fuzzy.index_build'):
+                    serials, tree = snapshot.serials, FuzzyIndex(snapshot.serials.key_rows())
+                self.fuzzy_cache = (snapshot.generation, serials, tree)
+            return serials, tree
+        finally:
+            self.fuzzy_lock.release()
+
+    def fleet_stats(self):
+        snapshot = index_snapshot
+        generation, stats = self.stats_cache
+        perf.cache('fleet_stats', generation == snapshot.generation)
+        if generation != snapshot.generation:
+            with timed('stats.build', rows=len(snapshot.serials.rows) if snapshot.serials else 0):
+                stats = FleetStats(snapshot.serials) if snapshot.serials else None
+            self.stats_cache = (snapshot.generation, stats)
+        return stats
+
+    def dropdown_catalog(self):
+        snapshot = index_snapshot
+        key = (snapshot.generation, use_indexing, None if use_indexing else int(time.time() // 600))
+        cached_key, cached_catalog = self.catalog_cache
+        perf.cache('dropdown_catalog', cached_key == key)
+        if cached_key == key:
+            return cached_catalog
+        catalog = DropdownCatalog(snapshot.entities if use_indexing else {}, self._download_entity_table)
+        self.catalog_cache = (key, catalog)
+        return catalog
+
+    def _download_entity_table(self, entity):
+        if entity == 'Contact':
+            return set(index_snapshot.entities.get('Contact', ()))
+        data = glpi_request('GET', entity, params={'range': '0-9999'})
+        field1 = entity_display[entity][0]
+        table = {}
+        for i in data:
+            if isinstance(i, dict) and 'id' in i:
+                if entity == 'User':
+                    table[str(i['id'])] = f"{i.get('realname', '')} {i.get('firstname', '')}".strip()
+                else:
+                    table[str(i['id'])] = i.get(field1, 'Не указано')
+        return table
 
     def paste_handler(self, event):
         try:
@@ -330,10 +2223,7 @@ class GLPIApp:
 
     def play_sound(self, success=True):
         if sound_enabled:
-            if success:
-                winsound.Beep(1000, 200)
-            else:
-                winsound.Beep(500, 300)
+            feedback.play(success)
 
     def open_item_link(self, serial):
         if serial not in self.found_items:
@@ -365,6 +2255,12 @@ class GLPIApp:
             self.log("Ошибка: пустой ввод")
             return
 
+        buffer_key = self._add_buffer_row(s)
+        self.lookup_pool.submit(self._search_serial, s, buffer_key)
+        self.entry.delete(0, 'end')
+        self.update_counters()
+
+    def _add_buffer_row(self, s):
         buffer_key = f"{s}_{len(self.buffer_items)}"
         self.buffer_items[buffer_key] = s
 
@@ -375,6 +2271,7 @@ class GLPIApp:
         # --- Отображение: номер, департамент, стеллаж, кнопки ---
         # Инвентарный номер (без департамента, без лишнего width)
         dep_name = ""
+        entity_index = index_snapshot.entities
         found_item = self.found_items.get(s)
         if found_item:
             t, i = found_item
@@ -404,18 +2301,122 @@ class GLPIApp:
                                                         command=lambda x=buffer_key: self.remove_serial(x),
                                                         fg_color="#101010", font=("Arial", scaled_font(12)), width=30)
         self.remove_buttons[buffer_key].pack(side='left', padx=5)
+        return buffer_key
 
-        threading.Thread(target=self._search_serial, args=(s, buffer_key), daemon=True).start()
-        self.entry.delete(0, 'end')
+    def _search_serial(self, s, buffer_key):
+        with timed('lookup'):
+            items = self._lookup_items(s)
+
+        if not items:
+            fuzzy = self._fuzzy_items(s)
+            if fuzzy:
+                self.log(f"Точного совпадения для {s} нет, похожих номеров: {len(fuzzy)}")
+                self.ui(self._mark_not_found, buffer_key)  # останется так, если окно выбора закроют
+                self.play_sound(False)
+                self.ui(self.show_selection_window, s, fuzzy, buffer_key, True)
+                return
+            self.ui(self._mark_not_found, buffer_key)
+            self.play_sound(False)
+            self.log(f"Не найден: {s}")
+        elif len(items) == 1:
+            self.ui(self._process_single_item, s, items[0], buffer_key)
+        else:
+            self.ui(self.show_selection_window, s, self._rank_items(s, items), buffer_key)
+
+    def _fuzzy_items(self, s):
+        # Номер с повреждённого штрихкода или набранный с ошибкой: ближайшие номера индекса
+        if not use_indexing or not index_snapshot.serials:
+            return []
+        fuzzy = self.fuzzy_index(wait=False)
+        if fuzzy is None:
+            self.log("Индекс похожих номеров ещё строится")
+            return []
+        serials, tree = fuzzy
+        with timed('lookup.fuzzy'):
+            items = self._rank_items(s, [serials.item(row) for row in tree.candidates(s)])
+        return [item for item in items if self._distance(s, item) <= 2][:FUZZY_LIMIT]
+
+    @staticmethod
+    def _distance(s, item):
+        keys = [str(k).lstrip('0') for k in (item[1].get('otherserial'), item[1].get('serial')) if k]
+        return min((edit_distance(s, k) for k in keys), default=len(s))
+
+    def _rank_items(self, s, items):
+        # Сначала самые близкие к введённому номеру
+        return sorted(items, key=lambda item: self._distance(s, item))
+
+    def schedule_prefetch(self):
+        # Полные записи буфера дозагружаются пачками после паузы во вводе, а не по одной при открытии
+        if self.prefetch_job is None:
+            self.prefetch_job = self.root.after(PREFETCH_DELAY_MS, self.prefetch_details)
+
+    def prefetch_details(self):
+        self.prefetch_job = None
+        if self.offline:
+            return
+        if self.prefetch_running:
+            self.schedule_prefetch()  # новые позиции подождут окончания текущей загрузки
+            return
+        keys = list(dict.fromkeys((t, i['id']) for t, i in self.found_items.values()
+                                  if 'id' in i and (t, i['id']) not in self.item_details))
+        if not keys:
+            return
+        self.prefetch_running = True
+        generation = self.details_generation
+        future = async_service.submit(glpi_get_multiple(keys))
+        future.add_done_callback(lambda fut: self.ui(self._prefetch_done, fut, len(keys), generation))
+
+    def _prefetch_done(self, future, requested, generation):
+        self.prefetch_running = False
+        try:
+            details, failed = future.result()
+        except GLPIError as e:
+            self.log(f"Ошибка загрузки полных записей: {e}")
+            return
+        if generation != self.details_generation:
+            # Пока шла загрузка, позиции изменили или буфер очистили - записи могли устареть
+            if self.found_items:
+                self.schedule_prefetch()
+            return
+        self.item_details.update(details)
+        self.log(f"Полные записи загружены: {len(details)} из {requested}"
+                 + (f", ошибок в порциях: {failed}" if failed else ""))
+
+    def _mark_not_found(self, buffer_key):
+        if buffer_key in self.status_labels:
+            self.status_labels[buffer_key].configure(fg_color="#992020", text="Не найден", text_color="white")
         self.update_counters()
 
-    def _search_serial(self, s, buffer_key):
+    def _lookup_items(self, s):
+        if self.offline:
+            return self._lookup_offline(s)
+        if self.audit and use_indexing:
+            # При инвентаризации точный номер берётся из индекса, без запроса к GLPI на каждое сканирование
+            hit = index_snapshot.serials.get(s)
+            if hit:
+                return [hit]
         items = []
-        for t in ['Computer', 'Monitor', 'Peripheral']:
+        item_types = ['Computer', 'Monitor', 'Peripheral']
+
+        async def fetch_all():
+            return await asyncio.gather(*[glpi_request_async('GET', t, params={'range': '0-9999'})
+                                          for t in item_types], return_exceptions=True)
+
+        # Три таблицы загружаются параллельно в общем цикле, сопоставление идёт в рабочем потоке
+        try:
+            responses = async_service.call(fetch_all())
+        except GLPIError as e:
+            # Общий таймаут трактуется как отсутствие ответа от всех трёх таблиц
+            responses = [e] * len(item_types)
+        if all(isinstance(r, GLPIError) and r.status is None for r in responses):
+            # Ни одна таблица не ответила: сервер недоступен, ищем по сохранённому индексу
+            self.ui(self.set_offline, True, 'нет связи с GLPI')
+            if index_snapshot.serials:
+                return self._lookup_offline(s)
+        for t, response_data in zip(item_types, responses):
             try:
-                r = requests.get(f'{base_url}/{t}', headers=headers, params={'range': '0-9999'}, timeout=10)
-                r.raise_for_status()
-                response_data = r.json()
+                if isinstance(response_data, Exception):
+                    raise response_data
                 if not isinstance(response_data, list):
                     self.log(f"Некорректный ответ для {t}: {response_data}")
                     continue
@@ -425,23 +2426,27 @@ class GLPIApp:
                     # Проверяем совпадение как по инвентарному, так и по серийному номеру
                     if (otherserial and s in otherserial) or (serial and s in serial):
                         items.append((t, item))
-            except requests.RequestException as e:
+            except GLPIError as e:
                 self.log(f"Ошибка поиска {s} в {t}: {e}")
             except (ValueError, KeyError) as e:
                 self.log(f"Ошибка обработки данных для {t}: {e}")
-
-        if not items:
-            self.root.after(0, lambda: self.status_labels[buffer_key].configure(fg_color="#992020", text="Не найден",
-                                                                                text_color="white"))
-            self.play_sound(False)
-            self.log(f"Не найден: {s}")
-            self.root.after(0, self.update_counters)
-        elif len(items) == 1:
-            self._process_single_item(s, items[0], buffer_key)
-        else:
-            self.root.after(0, lambda: self.show_selection_window(s, items, buffer_key))
-
-    def _process_single_item(self, s, item, buffer_key):
+        return items
+
+    def _lookup_offline(self, s):
+        # То же совпадение по подстроке, что и онлайн; позиция может быть в индексе под двумя номерами
+        serials = index_snapshot.serials
+        with timed('lookup.offline'):
+            exact = serials.find_row(s)
+            rows = {row for key, row in serials.key_rows() if s in key}
+        # Точное совпадение номера - первым, как самый вероятный вариант
+        ordered = ([exact] if exact is not None else []) + sorted(rows - {exact})
+        return [serials.item(row) for row in ordered]
+
+    def _process_single_item(self, s, item, buffer_key, quiet=False):
+        # Выполняется только в потоке Tk: проверка дубликата и запись в found_items не гоняются между потоками
+        if buffer_key not in self.buffer_items:
+            return
+        entity_index = index_snapshot.entities
         t, i = item
         otherserial = i.get('otherserial', '').lstrip('0')
         serial = i.get('serial', '').lstrip('0')
@@ -465,31 +2470,50 @@ class GLPIApp:
             self.labels[buffer_key].configure(text=label_text)
 
         if duplicate:
-            self.root.after(0, lambda: [
-                self.status_labels[buffer_key].configure(fg_color="#101010", text="Дубликат", text_color="white"),
-                self.update_counters()
-            ])
-            self.play_sound(False)
-            self.log(f"Дубликат: {key_serial}")
+            # Позиция могла попасть в буфер до начала инвентаризации или импортом из индекса:
+            # первое сканирование при инвентаризации всё равно засчитывается
+            outcome = self.audit.scan(t, i) if self.audit is not None and not quiet else 'repeat'
+            if outcome == 'found':
+                self.status_labels[buffer_key].configure(fg_color="#388938", text=f"В буфере: {g} {d}",
+                                                         text_color="white")
+            elif outcome == 'unexpected':
+                self.status_labels[buffer_key].configure(fg_color="#cc7a00", text=f"Не отсюда: {g} {d}",
+                                                         text_color="white")
+            else:
+                self.status_labels[buffer_key].configure(fg_color="#101010", text="Дубликат", text_color="white")
+            self.update_counters()
+            if self.audit and not quiet:
+                self.update_audit_label()
+            if not quiet:
+                self.play_sound(outcome == 'found')
+            self.log(f"{'Найден' if outcome == 'found' else 'Лишний' if outcome == 'unexpected' else 'Дубликат'}: "
+                     f"{key_serial}")
         else:
-            self.root.after(0, lambda: [
-                self.found_items.update({key_serial: (t, i)}),
-                self.status_labels[buffer_key].configure(fg_color="#388938", text=f"{g} {d}", text_color="white"),
-                self.info_buttons[buffer_key].configure(state="normal"),
-                self.update_counters()
-            ])
-            self.play_sound(True)
-            self.log(f"Найден: {key_serial} ({g})")
-
-    def show_selection_window(self, serial, items, buffer_key):
+            self.found_items[key_serial] = (t, i)
+            self.status_labels[buffer_key].configure(fg_color="#388938", text=f"{g} {d}", text_color="white")
+            self.info_buttons[buffer_key].configure(state="normal")
+            self.update_counters()
+            self.schedule_prefetch()
+            unexpected = self.audit is not None and not quiet and self.audit.scan(t, i) == 'unexpected'
+            if unexpected:
+                self.status_labels[buffer_key].configure(fg_color="#cc7a00", text=f"Не отсюда: {g} {d}")
+                self.update_audit_label()
+            elif self.audit and not quiet:
+                self.update_audit_label()
+            if not quiet:
+                self.play_sound(not unexpected)
+            self.log(f"{'Лишний' if unexpected else 'Найден'}: {key_serial} ({g})")
+
+    def show_selection_window(self, serial, items, buffer_key, fuzzy=False):
         win = ctk.CTkToplevel(self.root)
         win.title(f"Выбор для {serial}")
         win.geometry("600x400")
         win.transient(self.root)
         win.grab_set()
 
-        ctk.CTkLabel(win, text=f"Найдено несколько совпадений для {serial}", font=("Arial", scaled_font(14), "bold"),
-                     text_color="white").pack(pady=10)
+        title = f"Точного совпадения нет, похожие номера для {serial}" if fuzzy else \
+            f"Найдено несколько совпадений для {serial}"
+        ctk.CTkLabel(win, text=title, font=("Arial", scaled_font(14), "bold"), text_color="white").pack(pady=10)
         scroll_frame = ctk.CTkScrollableFrame(win, fg_color="#2d2d2d", width=560)
         scroll_frame.pack(fill='both', expand=True, padx=10, pady=10)
 
@@ -518,7 +2542,11 @@ class GLPIApp:
             buffer_key]
         del self.buffer_items[buffer_key]
         if s not in self.buffer_items.values() and s in self.found_items:
-            del self.found_items[s]
+            if self.audit:
+                self.audit.unscan(*self.found_items[s])
+                self.update_audit_label()
+            t, i = self.found_items.pop(s)
+            self.item_details.pop((t, i.get('id')), None)
         self.log(f"Удалён: {s}")
         self.update_counters()
 
@@ -554,23 +2582,27 @@ class GLPIApp:
 
         t, i = self.found_items[s]
         item_id = i.get('id')
+        # Запись из пакетной дозагрузки уже полная и с названиями справочников - запросы не нужны
+        expanded = self.item_details.get((t, item_id))
+        perf.cache('item_details', expanded is not None)
 
-        try:
-            r = requests.get(f'{base_url}/{t}/{item_id}', headers=headers, timeout=5)
-            r.raise_for_status()
-            response_data = r.json()
-            if isinstance(response_data, dict):
-                i = response_data
-                self.found_items[s] = (t, i)
-                self.log(f"Информация загружена для {s} (ID: {item_id})")
-            else:
-                self.log(f"Некорректный ответ для {s}: {response_data}")
-        except requests.RequestException as e:
-            self.log(f"Ошибка загрузки данных для {s}: {e}")
-            i = self.found_items[s][1]
-        except (ValueError, KeyError) as e:
-            self.log(f"Ошибка обработки данных для {s}: {e}")
-            i = self.found_items[s][1]
+        if expanded is not None:
+            i = expanded
+        else:
+            try:
+                response_data = glpi_request('GET', f'{t}/{item_id}', timeout=5)
+                if isinstance(response_data, dict):
+                    i = response_data
+                    self.found_items[s] = (t, i)
+                    self.log(f"Информация загружена для {s} (ID: {item_id})")
+                else:
+                    self.log(f"Некорректный ответ для {s}: {response_data}")
+            except GLPIError as e:
+                self.log(f"Ошибка загрузки данных для {s}: {e}")
+                i = self.found_items[s][1]
+            except (ValueError, KeyError) as e:
+                self.log(f"Ошибка обработки данных для {s}: {e}")
+                i = self.found_items[s][1]
 
         ctk.CTkLabel(self.extended_frame, text=f"Инфо: {s}", font=("Arial", scaled_font(14), "bold"),
                      text_color="white", anchor="w").pack(pady=10, anchor="nw", padx=10)
@@ -580,6 +2612,7 @@ class GLPIApp:
         info_frame.grid_columnconfigure(1, weight=1)
 
         e = {'users_id': 'User', 'groups_id': 'Group', 'locations_id': 'Location', 'states_id': 'State'}
+        entity_index = index_snapshot.entities
         row = 0
         for display_name, glpi_field in field_mappings.items():
             if display_name not in field_visibility or not field_visibility[display_name]:
@@ -592,8 +2625,12 @@ class GLPIApp:
                     v = v if v else 'Не указано'
                 elif glpi_field in e:
                     entity_type = e[glpi_field]
-                    if use_indexing and entity_type in entity_index:
-                        v = entity_index[entity_type].get(str(v), 'Не указано')
+                    if expanded is not None or use_indexing and entity_type in entity_index:
+                        if expanded is not None:
+                            v = expanded_name(v)
+                        else:
+                            perf.cache('entity_index', str(v) in entity_index[entity_type])
+                            v = entity_index[entity_type].get(str(v), 'Не указано')
                         if entity_type == 'Location':
                             v = trim_location(v)
                             if len(v) > 30:
@@ -603,10 +2640,9 @@ class GLPIApp:
                                 elif len(v) > 40:
                                     v = v[:37] + '...'
                     else:
+                        perf.cache('entity_index', False)
                         try:
-                            r = requests.get(f'{base_url}/{entity_type}/{v}', headers=headers, timeout=5)
-                            r.raise_for_status()
-                            response_data = r.json()
+                            response_data = glpi_request('GET', f'{entity_type}/{v}', timeout=5)
                             if isinstance(response_data, list) and response_data:
                                 data = response_data[0]
                             elif isinstance(response_data, dict):
@@ -619,7 +2655,7 @@ class GLPIApp:
                             v = data.get(field1, 'Не указано')
                             if entity_type == 'Location':
                                 v = trim_location(v)
-                        except requests.RequestException as e:
+                        except GLPIError as e:
                             v = f'Не указано (ошибка: {e})'
                         except (ValueError, KeyError) as e:
                             v = f'Не указано (ошибка обработки: {e})'
@@ -672,6 +2708,8 @@ class GLPIApp:
             w.destroy()
         self.labels.clear(), self.info_buttons.clear(), self.remove_buttons.clear(), self.status_labels.clear()
         self.found_items.clear(), self.pending_serials.clear(), self.buffer_items.clear()
+        self.item_details.clear()
+        self.details_generation += 1
         self.log("Буфер очищен")
         self.update_counters()
 
@@ -684,7 +2722,13 @@ class GLPIApp:
         ctk.CTkLabel(self.extended_frame, text="Настройки", font=("Arial", scaled_font(16), "bold"),
                      text_color="white").pack(pady=(10, 20))
 
-        settings_frame = ctk.CTkFrame(self.extended_frame, corner_radius=10, fg_color="#3a3a3a")
+        tabs = ctk.CTkTabview(self.extended_frame, fg_color="#2d2d2d")
+        tabs.pack(fill='both', expand=True, padx=10)
+        general_tab = tabs.add("Основные")
+        diagnostics_tab = tabs.add("Диагностика")
+        self._build_diagnostics_tab(diagnostics_tab)
+
+        settings_frame = ctk.CTkFrame(general_tab, corner_radius=10, fg_color="#3a3a3a")
         settings_frame.pack(fill='x', padx=10, pady=10)
 
         checkbox_frame = ctk.CTkFrame(settings_frame, fg_color="#3a3a3a")
@@ -739,14 +2783,29 @@ class GLPIApp:
         copies_entry.grid(row=4, column=1, padx=5, pady=2)
         copies_entry.insert(0, str(print_copies))
 
+        ctk.CTkLabel(size_frame, text="Обновление индекса (мин, 0 - выкл):", font=("Arial", scaled_font(12)),
+                     text_color="white").grid(row=5, column=0, padx=5, pady=2, sticky='w')
+        refresh_entry = ctk.CTkEntry(size_frame, width=100, font=("Arial", scaled_font(12)))
+        refresh_entry.grid(row=5, column=1, padx=5, pady=2)
+        refresh_entry.insert(0, str(index_refresh_minutes))
+
+        ctk.CTkLabel(size_frame, text="Потоков поиска:", font=("Arial", scaled_font(12)),
+                     text_color="white").grid(row=6, column=0, padx=5, pady=2, sticky='w')
+        workers_entry = ctk.CTkEntry(size_frame, width=100, font=("Arial", scaled_font(12)))
+        workers_entry.grid(row=6, column=1, padx=5, pady=2)
+        workers_entry.insert(0, str(lookup_workers))
+
         def apply_sizes():
-            global main_window_size, extended_window_size, auth_window_size, font_scale, print_copies
+            global main_window_size, extended_window_size, auth_window_size, font_scale, print_copies, \
+                index_refresh_minutes, lookup_workers
             try:
                 main_size = main_size_entry.get().strip()
                 extended_size = extended_size_entry.get().strip()
                 auth_size = auth_size_entry.get().strip()
                 scale = int(scale_entry.get().strip())
                 copies = int(copies_entry.get().strip())
+                refresh_minutes = int(refresh_entry.get().strip())
+                workers = int(workers_entry.get().strip())
 
                 if not all(re.match(r'^\d+x\d+$', s) for s in [main_size, extended_size, auth_size]):
                     raise ValueError("Формат должен быть ШxВ, например, 1350x600")
@@ -758,11 +2817,22 @@ class GLPIApp:
                     raise ValueError("Масштаб должен быть от 50 до 200")
                 if not (1 <= copies <= 10):
                     raise ValueError("Количество копий должно быть от 1 до 10")
+                if not (0 <= refresh_minutes <= 1440):
+                    raise ValueError("Интервал обновления индекса должен быть от 0 до 1440 минут")
+                if not (1 <= workers <= 32):
+                    raise ValueError("Количество потоков поиска должно быть от 1 до 32")
 
                 main_window_size, extended_window_size, auth_window_size, font_scale, print_copies = main_size, extended_size, auth_size, scale, copies
+                index_refresh_minutes = refresh_minutes
+                if workers != lookup_workers:
+                    lookup_workers = workers
+                    self.lookup_pool.shutdown(wait=False)
+                    self.lookup_pool = ThreadPoolExecutor(max_workers=lookup_workers, thread_name_prefix='lookup')
                 save_config()
+                self.schedule_index_refresh()
                 self.log(
                     f"Размеры обновлены: main={main_size}, extended={extended_size}, auth={auth_size}, scale={scale}, copies={copies}")
+                self.log(f"Интервал обновления индекса: {refresh_minutes} мин")
                 messagebox.showinfo("Успех", "Настройки сохранены. Перезапустите программу для применения изменений.")
                 # Убираем self._collapse_extended_frame() — окно остаётся открытым
             except ValueError as e:
@@ -778,7 +2848,7 @@ class GLPIApp:
             if 'Session-Token' not in headers:
                 messagebox.showwarning("Предупреждение", "Сначала выполните авторизацию!")
                 return
-            threading.Thread(target=run_async_index, args=(self,), daemon=True).start()
+            run_async_index(self)
             messagebox.showinfo("Успех", "Переиндексация запущена в фоновом режиме!")
             self.log("Переиндексация запущена")
 
@@ -798,6 +2868,41 @@ class GLPIApp:
         ctk.CTkButton(button_frame2, text="Выход", command=exit_to_auth, fg_color="#ff5555",
                       font=("Arial", scaled_font(12)), width=130).pack(side='left', padx=5)
 
+    def _build_diagnostics_tab(self, parent):
+        stats_box = ctk.CTkTextbox(parent, font=("Consolas", scaled_font(10)), wrap='none', width=560, height=380)
+        stats_box.pack(fill='both', expand=True, padx=5, pady=5)
+
+        def refresh():
+            if not stats_box.winfo_exists():
+                return
+            rows, cache_rows = perf.summary()
+            lines = [f"{'Операция':<34}{'N':>7}{'Ошибки':>8}{'КБ':>10}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}"]
+            for r in rows:
+                lines.append(f"{r['name'][:33]:<34}{r['count']:>7}{r['errors']:>8}{r['bytes'] / 1024:>10.1f}"
+                             f"{r['p50'] * 1000:>9.1f}{r['p95'] * 1000:>9.1f}{r['p99'] * 1000:>9.1f}")
+            lines.append("")
+            lines.append(f"Лимит параллельных запросов: {int(limiter.limit)} (в работе {limiter.in_flight}, "
+                         f"в очереди {len(limiter.waiters)}, снижений {limiter.decreases})")
+            lines.append("")
+            lines.append(f"{'Кэш':<34}{'Попадания':>11}{'Промахи':>10}{'Доля':>8}")
+            for c in cache_rows:
+                lines.append(f"{c['name'][:33]:<34}{c['hits']:>11}{c['misses']:>10}{c['rate'] * 100:>7.1f}%")
+            stats_box.configure(state='normal')
+            stats_box.delete("0.0", "end")
+            stats_box.insert("0.0", "\n".join(lines))
+            stats_box.configure(state='disabled')
+            stats_box.after(2000, refresh)
+
+        trace_var = tk.BooleanVar(value=write_trace)
+        ctk.CTkCheckBox(parent, text=f"Писать trace-файл в режиме Debug ({os.path.basename(perf.trace_path)})",
+                        variable=trace_var, command=lambda: globals().update(write_trace=trace_var.get()),
+                        font=("Arial", scaled_font(12)), text_color="white").pack(anchor='w', padx=5, pady=5)
+        buttons = ctk.CTkFrame(parent, fg_color="#2d2d2d")
+        buttons.pack(fill='x', pady=5)
+        ctk.CTkButton(buttons, text="Сбросить", command=perf.reset, font=("Arial", scaled_font(12)),
+                      width=130).pack(side='left', padx=5)
+        refresh()
+
     def toggle_logs(self, show):
         global show_logs
         show_logs = show
@@ -832,32 +2937,11 @@ class GLPIApp:
         user_search_frame = None
         user_list_frame = None
         selected_value = tk.StringVar(value="Выберите значение")
-        all_users = []
         letter_combo = None
         number_combo = None
         clear_stelazh_button = None
         apply_timer = None  # Переменная для хранения ID таймера
 
-        def load_users():
-            nonlocal all_users
-            if use_indexing and 'User' in entity_index:
-                all_users = sorted([x for x in entity_index['User'].values() if
-                                    isinstance(x, str) and x != 'Не указано' and re.match(r'^[А-Яа-я\s]+$', x)],
-                                   key=lambda x: x.lower())
-            else:
-                try:
-                    r = requests.get(f'{base_url}/User', headers=headers, params={'range': '0-9999'}, timeout=10)
-                    r.raise_for_status()
-                    data = r.json()
-                    all_users = sorted([f"{i.get('realname', '')} {i.get('firstname', '')}".strip() for i in data if
-                                        (i.get('realname') or i.get('firstname')) and re.match(r'^[А-Яа-я\s]+$',
-                                                                                               f"{i.get('realname', '')} {i.get('firstname', '')}".strip())],
-                                       key=lambda x: x.lower())
-                except requests.RequestException as e:
-                    self.log(f"Ошибка загрузки пользователей: {e}")
-                    all_users = ['Не указано']
-            return all_users
-
         def update_value_widget(*args):
             nonlocal value_widget, user_search_frame, user_list_frame, letter_combo, number_combo, clear_stelazh_button
             if value_widget:
@@ -882,31 +2966,9 @@ class GLPIApp:
 
                 user_list_frame = ctk.CTkFrame(value_frame, corner_radius=10, fg_color="#2d2d2d")
                 user_list_frame.pack(fill='x', pady=5)
-                value_widget = ctk.CTkLabel(user_list_frame, textvariable=selected_value,
-                                            font=("Arial", scaled_font(12)), text_color="white")
-                value_widget.pack(pady=5)
-
-                users = load_users()
-                users.insert(0, "Очистить")
-
-                def filter_users(event):
-                    query = search_entry.get().strip().lower()
-                    filtered = [u for u in users if query in u.lower()] if query else users[:11]
-                    for widget in user_list_frame.winfo_children():
-                        widget.destroy()
-                    value_widget = ctk.CTkLabel(user_list_frame, textvariable=selected_value,
-                                                font=("Arial", scaled_font(12)), text_color="white")
-                    value_widget.pack(pady=5)
-                    if not filtered:
-                        ctk.CTkLabel(user_list_frame, text="Нет совпадений", font=("Arial", scaled_font(12)),
-                                     text_color="white").pack(pady=5)
-                    else:
-                        for user in filtered[:11]:
-                            ctk.CTkButton(user_list_frame, text=user, command=lambda u=user: selected_value.set(u),
-                                          font=("Arial", scaled_font(12)), width=280).pack(pady=2)
-
-                search_entry.bind("<KeyRelease>", filter_users)
-                filter_users(None)
+                picker = UserPicker(user_list_frame, search_entry, selected_value, self.user_index(), 11,
+                                    pinned=["Очистить"])
+                value_widget = picker.label
             elif param == 'Стеллаж':
                 value_widget = ctk.CTkFrame(value_frame, fg_color="#2d2d2d")
                 value_widget.pack(pady=5)
@@ -937,56 +2999,13 @@ class GLPIApp:
                 value_widget.pack()
             else:
                 value_widget = ctk.CTkComboBox(value_frame, width=300, font=("Arial", scaled_font(12)))
-                values = []
-                if param == 'Статус':
-                    if use_indexing and 'State' in entity_index:
-                        values = sorted(
-                            [x for x in entity_index['State'].values() if isinstance(x, str) and x != 'Не указано'],
-                            key=lambda x: x.lower())
-                    else:
-                        try:
-                            r = requests.get(f'{base_url}/State', headers=headers, params={'range': '0-9999'},
-                                             timeout=10)
-                            r.raise_for_status()
-                            data = r.json()
-                            values = sorted([i.get('completename', 'Не указано') for i in data],
-                                            key=lambda x: x.lower())
-                        except requests.RequestException as e:
-                            self.log(f"Ошибка загрузки статусов: {e}")
-                            values = ['Не указано']
-                elif param == 'Местоположение':
-                    if use_indexing and 'Location' in entity_index:
-                        values = [trim_location(x) for x in entity_index['Location'].values() if
-                                  isinstance(x, str) and x != 'Не указано']
-                        shortened = [f"{v.split('>')[0].strip()}>...>{v.split('>')[-1].strip()}" if len(
-                            v) > 30 and '>' in v else v[:37] + '...' if len(v) > 40 else v for v in values]
-                        values = sorted(shortened, key=lambda x: x.lower())
-                    else:
-                        try:
-                            r = requests.get(f'{base_url}/Location', headers=headers, params={'range': '0-9999'},
-                                             timeout=10)
-                            r.raise_for_status()
-                            data = r.json()
-                            values = sorted([trim_location(i.get('completename', 'Не указано')) for i in data],
-                                            key=lambda x: x.lower())
-                        except requests.RequestException as e:
-                            self.log(f"Ошибка загрузки местоположений: {e}")
-                            values = ['Не указано']
-                elif param == 'Департамент':
-                    if use_indexing and 'Group' in entity_index:
-                        values = sorted(
-                            [x for x in entity_index['Group'].values() if isinstance(x, str) and x != 'Не указано'],
-                            key=lambda x: x.lower())
-                    else:
-                        try:
-                            r = requests.get(f'{base_url}/Group', headers=headers, params={'range': '0-9999'},
-                                             timeout=10)
-                            r.raise_for_status()
-                            data = r.json()
-                            values = sorted([i.get('name', 'Не указано') for i in data], key=lambda x: x.lower())
-                        except requests.RequestException as e:
-                            self.log(f"Ошибка загрузки департаментов: {e}")
-                            values = ['Не указано']
+                entity = {'Статус': 'State', 'Местоположение': 'Location', 'Департамент': 'Group'}[param]
+                try:
+                    with timed('dropdown.values'):
+                        values = list(self.dropdown_catalog().edit_choices(entity))
+                except (GLPIError, ValueError) as e:
+                    self.log(f"Ошибка загрузки значений для {param}: {e}")
+                    values = ['Не указано']
                 values.insert(0, "Очистить")
                 value_widget.configure(values=values)
                 value_widget.set(values[0])
@@ -995,9 +3014,62 @@ class GLPIApp:
         param_combo.configure(command=update_value_widget)
         update_value_widget()
 
+        change_set = {}  # поле GLPI -> (параметр, отображаемое значение, значение для GLPI)
+        staged_frame = ctk.CTkFrame(self.extended_frame, corner_radius=10, fg_color="#3a3a3a")
+        staged_frame.pack(pady=5, fill='x')
+
+        def resolve_change():
+            param = param_combo.get()
+            new_value = value_widget.get() if param != 'Пользователь' and param != 'Стеллаж' else selected_value.get()
+            if new_value == "Выберите значение":
+                messagebox.showwarning("Предупреждение", "Выберите значение!")
+                return None
+            dropdown_fields = {'Пользователь': ('User', 'users_id'), 'Статус': ('State', 'states_id'),
+                               'Местоположение': ('Location', 'locations_id'),
+                               'Департамент': ('Group', 'groups_id')}
+            if param in dropdown_fields:
+                entity, glpi_field = dropdown_fields[param]
+                if new_value == "Очистить":
+                    return glpi_field, param, new_value, 0
+                try:
+                    entity_id = self.dropdown_catalog().lookup_id(entity, new_value)
+                except (GLPIError, ValueError) as e:
+                    self.log(f"Ошибка поиска значения {param}: {e}")
+                    return None
+                if entity_id is None:
+                    messagebox.showwarning("Предупреждение", f"Значение не найдено: {new_value}")
+                    return None
+                return glpi_field, param, new_value, entity_id
+            if param == 'Стеллаж':
+                return 'contact', param, new_value, "" if new_value == "Очистить" else new_value
+            if param == 'Комментарий':
+                return 'comment', param, new_value, new_value if new_value else ""
+            return None
+
+        def render_staged():
+            for widget in staged_frame.winfo_children():
+                widget.destroy()
+            if not change_set:
+                ctk.CTkLabel(staged_frame, text="Набор изменений пуст", font=("Arial", scaled_font(12)),
+                             text_color="gray").pack(pady=5)
+                return
+            for glpi_field, (param, display, _) in change_set.items():
+                row = ctk.CTkFrame(staged_frame, fg_color="#3a3a3a")
+                row.pack(fill='x', padx=5, pady=2)
+                ctk.CTkLabel(row, text=f"{param}: {display if display else 'Очищено'}", font=("Arial", scaled_font(12)),
+                             text_color="white", anchor="w", wraplength=300).pack(side='left', padx=5)
+                ctk.CTkButton(row, text="✕", width=30, fg_color="#101010", font=("Arial", scaled_font(12)),
+                              command=lambda f=glpi_field: [change_set.pop(f, None), render_staged()]).pack(side='right')
+
+        def stage_change():
+            change = resolve_change()
+            if change:
+                glpi_field, param, display, value = change
+                change_set[glpi_field] = (param, display, value)
+                render_staged()
+
         def apply():
             nonlocal apply_timer
-            global use_indexing, entity_index, base_url, headers
             apply_button = apply_btn  # Сохраняем ссылку на кнопку для использования внутри функции
 
             # Если кнопка уже в состоянии "Уверены?" и нажата повторно
@@ -1007,122 +3079,150 @@ class GLPIApp:
                     apply_timer = None
                 apply_button.configure(text="Применить")  # Возвращаем исходный текст
 
-                # Применяем изменения
-                param = param_combo.get()
-                new_value = value_widget.get() if param != 'Пользователь' and param != 'Стеллаж' else selected_value.get()
-                if new_value == "Выберите значение":
-                    messagebox.showwarning("Предупреждение", "Выберите значение!")
-                    return
-                update_data = {}
-                if param == 'Пользователь':
-                    if new_value == "Очистить":
-                        update_data['users_id'] = 0
-                    else:
-                        if use_indexing and 'User' in entity_index:
-                            user_id = next(
-                                (k for k, v in entity_index['User'].items() if v.startswith(new_value.split('...')[0])),
-                                None)
-                        else:
-                            try:
-                                r = requests.get(f'{base_url}/User', headers=headers, params={'range': '0-9999'},
-                                                 timeout=10)
-                                r.raise_for_status()
-                                data = r.json()
-                                user_id = next((i['id'] for i in data if
-                                                f"{i.get('realname', '')} {i.get('firstname', '')}".strip().startswith(
-                                                    new_value.split('...')[0])), None)
-                            except requests.RequestException as e:
-                                self.log(f"Ошибка поиска пользователя: {e}")
-                                return
-                        update_data['users_id'] = user_id
-                elif param == 'Статус':
-                    if new_value == "Очистить":
-                        update_data['states_id'] = 0
-                    else:
-                        if use_indexing and 'State' in entity_index:
-                            state_id = next(
-                                (k for k, v in entity_index['State'].items() if
-                                 v.startswith(new_value.split('...')[0])),
-                                None)
-                        else:
-                            try:
-                                r = requests.get(f'{base_url}/State', headers=headers, params={'range': '0-9999'},
-                                                 timeout=10)
-                                r.raise_for_status()
-                                data = r.json()
-                                state_id = next((i['id'] for i in data if
-                                                 i.get('completename', '').startswith(new_value.split('...')[0])), None)
-                            except requests.RequestException as e:
-                                self.log(f"Ошибка поиска статуса: {e}")
-                                return
-                        update_data['states_id'] = state_id
-                elif param == 'Стеллаж':
-                    if new_value == "Очистить":
-                        update_data['contact'] = ""
-                    else:
-                        update_data['contact'] = new_value
-                elif param == 'Местоположение':
-                    if new_value == "Очистить":
-                        update_data['locations_id'] = 0
-                    else:
-                        if use_indexing and 'Location' in entity_index:
-                            location_id = next((k for k, v in entity_index['Location'].items() if
-                                                trim_location(v).startswith(new_value.split('...')[0])), None)
-                        else:
-                            try:
-                                r = requests.get(f'{base_url}/Location', headers=headers, params={'range': '0-9999'},
-                                                 timeout=10)
-                                r.raise_for_status()
-                                data = r.json()
-                                location_id = next((i['id'] for i in data if
-                                                    trim_location(i.get('completename', '')).startswith(
-                                                        new_value.split('...')[0])), None)
-                            except requests.RequestException as e:
-                                self.log(f"Ошибка поиска местоположения: {e}")
-                                return
-                        update_data['locations_id'] = location_id
-                elif param == 'Департамент':
-                    if new_value == "Очистить":
-                        update_data['groups_id'] = 0
-                    else:
-                        if use_indexing and 'Group' in entity_index:
-                            group_id = next((k for k, v in entity_index['Group'].items() if v == new_value), None)
-                        else:
-                            try:
-                                r = requests.get(f'{base_url}/Group', headers=headers, params={'range': '0-9999'},
-                                                 timeout=10)
-                                r.raise_for_status()
-                                data = r.json()
-                                group_id = next((i['id'] for i in data if i.get('name') == new_value), None)
-                            except requests.RequestException as e:
-                                self.log(f"Ошибка поиска департамента: {e}")
-                                return
-                        update_data['groups_id'] = group_id
-                elif param == 'Комментарий':
-                    update_data['comment'] = new_value if new_value else ""
+                # Применяем весь набор изменений, а если он пуст - текущий выбор
+                changes = dict(change_set)
+                if not changes:
+                    change = resolve_change()
+                    if not change:
+                        return
+                    glpi_field, param, display, value = change
+                    changes[glpi_field] = (param, display, value)
 
+                plan = []
                 for s, (t, i) in self.found_items.items():
-                    if 'comment' in update_data and i.get('comment') and new_value:
-                        update_data['comment'] = f"{i.get('comment', '')}\n{new_value}"
-                    try:
-                        r = requests.put(f'{base_url}/{t}/{i["id"]}', headers=headers, json={'input': update_data},
-                                         timeout=10)
-                        r.raise_for_status()
-                        i.update(update_data)
-                        self.found_items[s] = (t, i)
-                        self.log(f"Обновлено: {s} ({param}: {new_value if new_value else 'Очищено'})")
-                    except requests.RequestException as e:
-                        self.log(f"Ошибка обновления {s}: {e}")
+                    fields = {glpi_field: value for glpi_field, (_, _, value) in changes.items()}
+                    if fields.get('comment') and i.get('comment'):
+                        fields['comment'] = f"{i.get('comment', '')}\n{fields['comment']}"
+                    plan.append((s, t, i, fields))
+                description = ", ".join(f"{param}: {display if display else 'Очищено'}"
+                                        for param, display, _ in changes.values())
+                self.apply_updates(plan, description)
+                change_set.clear()
+                render_staged()
             else:
                 # Первое нажатие: меняем текст кнопки и запускаем таймер
                 apply_button.configure(text="Уверены?")
                 apply_timer = self.root.after(5000, lambda: apply_button.configure(text="Применить"))  # 5 секунд
 
+        render_staged()
+        ctk.CTkButton(self.extended_frame, text="Добавить в набор", command=stage_change,
+                      font=("Arial", scaled_font(12))).pack(pady=5)
         # Создаём кнопку "Применить"
         apply_btn = ctk.CTkButton(self.extended_frame, text="Применить", command=apply, font=("Arial", scaled_font(12)))
         apply_btn.pack(pady=5)
         ctk.CTkButton(self.extended_frame, text="Закрыть", command=self._collapse_extended_frame,
                       font=("Arial", scaled_font(12))).pack(pady=5)
+
+    def apply_updates(self, plan, description):
+        # plan: [(номер, тип, запись, поля)]; перед отправкой всё записывается в журнал
+        try:
+            journal = UpdateJournal.create(description, plan, queued=self.offline)
+        except OSError as e:
+            self.log(f"Ошибка создания журнала изменений: {e}")
+            messagebox.showerror("Ошибка", f"Не удалось создать журнал изменений: {e}")
+            return
+        if self.offline:
+            self.log(f"Офлайн: изменения поставлены в очередь, {len(plan)} позиций ({description})")
+            return
+        local_items = {f"{t}/{i['id']}": i for _, t, i, _ in plan}
+        self.log(f"Отправка изменений: {len(plan)} позиций ({description})")
+        self._run_journal(journal, local_items)
+
+    def resume_journal(self, journal):
+        # Локальные записи для обновления берём из буфера, если позиции там есть
+        local_items = {f"{t}/{i['id']}": i for t, i in self.found_items.values()}
+        self.log(f"Продолжение операции «{journal.header.get('description', '')}»: "
+                 f"осталось {len(journal.outstanding())} позиций")
+        self._run_journal(journal, local_items)
+
+    def _run_journal(self, journal, local_items):
+        keys = [key for key, _ in journal.outstanding()]
+        self.active_journals.add(journal.path)
+        future = async_service.submit(self._send_updates(journal))
+        future.add_done_callback(lambda f: self.ui(self._updates_done, f, journal, keys, local_items))
+
+    async def _send_updates(self, journal):
+        for attempt in range(UPDATE_MAX_ATTEMPTS):
+            outstanding = journal.outstanding()
+            if not outstanding or self.offline:
+                break
+            if attempt:
+                delay = min(30.0, 2.0 ** attempt) * random.uniform(0.8, 1.2)
+                self.log(f"Повтор {len(outstanding)} позиций через {delay:.0f} с (попытка {attempt + 1})")
+                await asyncio.sleep(delay)
+            by_type = {}
+            for key, entry in outstanding:
+                by_type.setdefault(entry['type'], []).append((key, entry))
+            chunks = []
+            for t, entries in by_type.items():
+                for k in range(0, len(entries), UPDATE_CHUNK_SIZE):
+                    chunks.append((t, entries[k:k + UPDATE_CHUNK_SIZE]))
+            await asyncio.gather(*[self._send_update_chunk(journal, t, entries) for t, entries in chunks])
+        await asyncio.get_running_loop().run_in_executor(None, journal.finish)
+
+    async def _send_update_chunk(self, journal, t, entries):
+        # Запись в журнал (с fsync) идёт в рабочем потоке, чтобы не останавливать общий цикл asyncio;
+        # пачка считается обработанной только после того, как её результат лёг на диск
+        loop = asyncio.get_running_loop()
+        inputs = [dict(entry['fields'], id=entry['id']) for _, entry in entries]
+        try:
+            statuses = await glpi_update_items(t, inputs)
+        except (GLPIError, ValueError) as e:
+            await loop.run_in_executor(None, journal.mark, [(key, False, str(e)) for key, _ in entries])
+            if getattr(e, 'status', 0) is None:
+                # Связь пропала посреди операции: остаток отправится из очереди
+                await loop.run_in_executor(None, journal.queue)
+                self.ui(self.set_offline, True, 'нет связи с GLPI')
+            return
+        await loop.run_in_executor(None, journal.mark, [
+            (key,) + statuses.get(str(entry['id']), (False, 'нет ответа сервера')) for key, entry in entries])
+
+    def _updates_done(self, future, journal, keys, local_items):
+        self.active_journals.discard(journal.path)
+        if future.exception():
+            self.log(f"Ошибка обновления: {future.exception()}")
+            return
+        description = journal.header.get('description', '')
+        updated, failed = 0, []
+        self.details_generation += 1  # дозагрузка, начатая до изменения, вернёт старые названия
+        for key in keys:
+            entry = journal.entries[key]
+            if entry['state'] == 'done':
+                updated += 1
+                if key in local_items:
+                    local_items[key].update(entry['fields'])
+                self.item_details.pop((entry['type'], entry['id']), None)  # названия могли измениться
+                self.log(f"Обновлено: {entry['serial']} ({description})")
+            else:
+                failed.append(entry)
+                self.log(f"Ошибка обновления {entry['serial']}: {entry['message']}")
+        self.log(f"Изменения применены: {updated} из {len(keys)}")
+        if failed and self.offline:
+            journal.queue()
+            self.log(f"Офлайн: {len(failed)} позиций остались в очереди")
+        elif failed and messagebox.askyesno(
+                "Ошибки обновления",
+                f"Не удалось обновить {len(failed)} позиций после {UPDATE_MAX_ATTEMPTS} попыток.\n"
+                f"Операция сохранена в журнале. Повторить сейчас?"):
+            self.resume_journal(journal)
+
+    def check_unfinished_journals(self):
+        for journal in UpdateJournal.unfinished(self.active_journals):
+            if journal.header.get('queued'):
+                self.resume_journal(journal)
+                continue
+            created = time.strftime('%d.%m.%Y %H:%M', time.localtime(journal.header.get('created', 0)))
+            answer = messagebox.askyesnocancel(
+                "Незавершённая операция",
+                f"Найдена прерванная операция от {created}:\n«{journal.header.get('description', '')}»\n"
+                f"Осталось позиций: {len(journal.outstanding())}.\n\n"
+                f"Да - продолжить, Нет - отменить операцию, Отмена - спросить позже")
+            if answer:
+                self.resume_journal(journal)
+            elif answer is False:
+                journal.discard()
+                self.log(f"Операция «{journal.header.get('description', '')}» отменена")
+
     def acts(self):
         if not self.found_items:
             self.play_sound(False)
@@ -1156,49 +3256,7 @@ class GLPIApp:
         user_list_frame = ctk.CTkFrame(self.extended_frame, corner_radius=10, fg_color="#2d2d2d")
         user_list_frame.pack(fill='x', pady=5)
         selected_user = tk.StringVar(value="Выберите пользователя")
-        user_label = ctk.CTkLabel(user_list_frame, textvariable=selected_user, font=("Arial", scaled_font(12)),
-                                  text_color="white")
-        user_label.pack(pady=5)
-
-        def load_users():
-            if use_indexing and 'User' in entity_index:
-                users = sorted([x for x in entity_index['User'].values() if
-                                isinstance(x, str) and x != 'Не указано' and re.match(r'^[А-Яа-я\s]+$', x)],
-                               key=lambda x: x.lower())
-            else:
-                try:
-                    r = requests.get(f'{base_url}/User', headers=headers, params={'range': '0-9999'}, timeout=10)
-                    r.raise_for_status()
-                    data = r.json()
-                    users = sorted([f"{i.get('realname', '')} {i.get('firstname', '')}".strip() for i in data if
-                                    (i.get('realname') or i.get('firstname')) and re.match(r'^[А-Яа-я\s]+$',
-                                                                                           f"{i.get('realname', '')} {i.get('firstname', '')}".strip())],
-                                   key=lambda x: x.lower())
-                except requests.RequestException as e:
-                    self.log(f"Ошибка загрузки пользователей: {e}")
-                    users = ['Не указано']
-            return users
-
-        users = load_users()
-
-        def filter_users(event):
-            query = search_entry.get().strip().lower()
-            filtered = [u for u in users if query in u.lower()] if query else users[:10]
-            for widget in user_list_frame.winfo_children():
-                widget.destroy()
-            user_label = ctk.CTkLabel(user_list_frame, textvariable=selected_user, font=("Arial", scaled_font(12)),
-                                      text_color="white")
-            user_label.pack(pady=5)
-            if not filtered:
-                ctk.CTkLabel(user_list_frame, text="Нет совпадений", font=("Arial", scaled_font(12)),
-                             text_color="white").pack(pady=5)
-            else:
-                for user in filtered[:10]:
-                    ctk.CTkButton(user_list_frame, text=user, command=lambda u=user: selected_user.set(u),
-                                  font=("Arial", scaled_font(12)), width=280).pack(pady=2)
-
-        search_entry.bind("<KeyRelease>", filter_users)
-        filter_users(None)
+        UserPicker(user_list_frame, search_entry, selected_user, self.user_index(), 10)
 
         button_frame = ctk.CTkFrame(self.extended_frame, corner_radius=10, fg_color="#2d2d2d")
         button_frame.pack(pady=10)
@@ -1238,6 +3296,10 @@ class GLPIApp:
                       font=("Arial", scaled_font(12))).pack(side='left', padx=5)
 
     def generate_act(self, act_type, user):
+        with timed('act.generate', act_type=act_type):
+            return self._generate_act(act_type, user)
+
+    def _generate_act(self, act_type, user):
         try:
             template_map = {'Выдача': 'issuance.xlsx', 'Возврат': 'return.xlsx', 'Выкуп': 'redemption.xlsx'}
             if act_type not in template_map:
@@ -1282,6 +3344,10 @@ class GLPIApp:
                 self.log(f"Файл для печати не найден: {filename}")
                 messagebox.showerror("Ошибка", f"Файл не найден: {filename}")
                 return
+            if win32com is None:
+                self.log("Печать недоступна: не установлен пакет pywin32")
+                messagebox.showerror("Ошибка", f"Печать недоступна без пакета pywin32, акт сохранён в {filename}")
+                return
                 
             excel = win32com.client.Dispatch("Excel.Application")
             excel.Visible = False
@@ -1318,8 +3384,8 @@ class GLPIApp:
         f.pack(pady=20, padx=20, fill='both', expand=True)
 
         ctk.CTkLabel(f, text="Прессет:", font=("Arial", scaled_font(12)), text_color="white").pack(pady=5)
-        history_combo = ctk.CTkComboBox(f, values=[h.get('name', f"{h['base_url']} - {h['user_token'][:8]}...") for h in
-                                                   auth_history], font=("Arial", scaled_font(12)))
+        history_combo = ctk.CTkComboBox(f, values=[preset_name(h) for h in auth_history],
+                                        font=("Arial", scaled_font(12)))
         history_combo.pack(pady=5)
         history_combo.set("")
         history_combo._dropdown_menu.bind("<MouseWheel>",
@@ -1361,7 +3427,7 @@ class GLPIApp:
             if not selection:
                 return
             for h in auth_history:
-                if h.get('name', f"{h['base_url']} - {h['user_token'][:8]}...") == selection:
+                if preset_name(h) == selection:
                     u.delete(0, 'end')
                     u.insert(0, h['base_url'])
                     a.delete(0, 'end')
@@ -1374,44 +3440,95 @@ class GLPIApp:
 
         history_combo.configure(command=load_history)
 
+        status_label = ctk.CTkLabel(f, text="", font=("Arial", scaled_font(11)), text_color="#aaaaaa")
+        status_label.pack(pady=2)
+
         def apply():
-            global base_url, app_token, user_token, headers, auth_success
+            # Вход не блокирует окно: initSession идёт в цикле asyncio, а сохранённый индекс
+            # выбранного сервера параллельно читается с диска в рабочем потоке
+            global base_url, app_token, user_token, headers
             base_url, app_token, user_token = u.get(), a.get(), ut.get()
             headers = {'App-Token': app_token, 'Authorization': f'user_token {user_token}',
                        'Content-Type': 'application/json'}
+            drop_foreign_index(base_url)
             self.log("Попытка авторизации...")
+            apply_button.configure(state="disabled")
+            status_label.configure(text="Подключение к GLPI...")
+            cache_future = self.lookup_pool.submit(read_index_cache, base_url) if use_indexing else None
+            session_future = async_service.submit(glpi_request_async('GET', 'initSession', timeout=5))
+            session_future.add_done_callback(lambda fut: self.ui(auth_done, fut, cache_future))
+
+        def cached_index(cache_future):
             try:
-                r = requests.get(f'{base_url}/initSession', headers=headers, timeout=5)
-                r.raise_for_status()
-                response_data = r.json()
-                if isinstance(response_data, dict) and 'session_token' in response_data:
-                    headers['Session-Token'] = response_data['session_token']
-                    self.log("Сессия создана успешно")
-                    if remember_var.get():
-                        auth_entry = {'base_url': base_url, 'app_token': app_token, 'user_token': user_token,
-                                      'name': name_entry.get().strip() or f"{base_url} - {user_token[:8]}..."}
-                        if auth_entry not in auth_history:
-                            auth_history.append(auth_entry)
-                        save_config()
-                        self.log("Настройки сохранены")
-                    auth_success = True
-                    w.destroy()
-                    self.log("Показ главного окна...")
-                    self.root.deiconify()
-                    self.root.update()
-                    if use_indexing and 'Session-Token' in headers:
-                        threading.Thread(target=run_async_index, args=(self,), daemon=True).start()
-                        self.log("Индексация запущена в фоновом режиме")
-                else:
+                return cache_future.result() if cache_future else None
+            except Exception as e:
+                self.log(f"Ошибка чтения сохранённого индекса: {e}")
+                return None
+
+        def show_main_window():
+            global auth_success
+            auth_success = True
+            w.destroy()
+            self.log("Показ главного окна...")
+            self.root.deiconify()
+            self.root.update()
+
+        def auth_done(session_future, cache_future):
+            if not w.winfo_exists():
+                return
+            apply_button.configure(state="normal")
+            status_label.configure(text="")
+            try:
+                response_data = session_future.result()
+                if not isinstance(response_data, dict) or 'session_token' not in response_data:
                     raise ValueError("Некорректный ответ сервера")
-            except requests.RequestException as e:
+            except GLPIError as e:
                 self.log(f"Ошибка авторизации: {e}")
                 apply_button.configure(fg_color="#ff5555")
-                messagebox.showerror("Ошибка", f"Не удалось авторизоваться: {e}")
+                if e.status is None and os.path.exists(index_cache_path()) and messagebox.askyesno(
+                        "Сервер недоступен",
+                        f"Не удалось подключиться: {e}\n\nРаботать офлайн по сохранённому индексу? "
+                        f"Изменения будут отправлены при появлении связи."):
+                    cached = cached_index(cache_future) or read_index_cache()
+                    if cached:
+                        publish_index(*cached)
+                        show_main_window()
+                        self.set_offline(True, 'сервер недоступен')
+                        self.schedule_index_refresh()
+                        return
+                    messagebox.showerror("Ошибка", "Нет сохранённого индекса для этого сервера")
+                else:
+                    messagebox.showerror("Ошибка", f"Не удалось авторизоваться: {e}")
+                return
             except (ValueError, KeyError) as e:
                 self.log(f"Ошибка обработки ответа сервера: {e}")
                 apply_button.configure(fg_color="#ff5555")
                 messagebox.showerror("Ошибка", f"Некорректный ответ сервера: {e}")
+                return
+            headers['Session-Token'] = response_data['session_token']
+            self.log("Сессия создана успешно")
+            if remember_var.get():
+                auth_entry = {'base_url': base_url, 'app_token': app_token, 'user_token': user_token,
+                              'name': name_entry.get().strip() or f"{base_url} - {user_token[:8]}..."}
+                if auth_entry not in auth_history:
+                    auth_history.append(auth_entry)
+                save_config()
+                self.log("Настройки сохранены")
+            show_main_window()
+            if use_indexing:
+                # Индекс с диска ещё может читаться - индексация стартует, как только он будет готов
+                cache_future.add_done_callback(lambda fut: self.ui(start_indexing, fut))
+            self.schedule_index_refresh()
+            self.check_unfinished_journals()
+
+        def start_indexing(cache_future):
+            cached = cached_index(cache_future)
+            if cached:
+                snapshot = publish_index(*cached)
+                built = time.strftime('%d.%m.%Y %H:%M', time.localtime(snapshot.built_at))
+                self.log(f"Загружен сохранённый индекс от {built}, позиций: {len(snapshot.serials)}")
+            run_async_index(self, delta=bool(cached))
+            self.log("Индексация запущена в фоновом режиме")
 
         apply_button.configure(command=apply)
 
@@ -1423,6 +3540,290 @@ class GLPIApp:
 
         w.protocol("WM_DELETE_WINDOW", on_closing_auth)
 
+    def update_audit_label(self):
+        if self.audit is None:
+            self.audit_label.pack_forget()
+            return
+        expected, found, missing, unexpected = self.audit.counts()
+        self.audit_label.configure(text=f"Аудит: {found}/{expected}, недостаёт {missing}, лишних {unexpected}")
+        self.audit_label.pack(anchor='w')
+
+    def audit_window(self):
+        win = ctk.CTkToplevel(self.root)
+        win.title("Инвентаризация")
+        win.geometry("520x420")
+        win.transient(self.root)
+        win.grab_set()
+
+        if self.audit is not None:
+            expected, found, missing, unexpected = self.audit.counts()
+            ctk.CTkLabel(win, text=self.audit.title, font=("Arial", scaled_font(14), "bold"),
+                         text_color="white").pack(pady=10)
+            ctk.CTkLabel(win, text=f"Ожидается: {expected}\nНайдено: {found}\nНедостаёт: {missing}\n"
+                                   f"Лишних: {unexpected}", font=("Arial", scaled_font(12)),
+                         text_color="white", justify='left').pack(pady=10)
+
+            def finish():
+                if not messagebox.askyesno("Подтверждение",
+                                           "Завершить инвентаризацию? Несохранённый отчёт будет потерян."):
+                    return
+                self.log(f"Инвентаризация завершена: {self.audit.title}")
+                self.audit = None
+                self.update_audit_label()
+                win.destroy()
+
+            ctk.CTkButton(win, text="Сохранить отчёт", command=self.save_audit_report).pack(pady=5)
+            ctk.CTkButton(win, text="Завершить инвентаризацию", command=finish, fg_color="#ff5555").pack(pady=5)
+            ctk.CTkButton(win, text="Закрыть", command=win.destroy).pack(pady=5)
+            return
+
+        ctk.CTkLabel(win, text="Новая инвентаризация: ожидаемый состав из индекса",
+                     font=("Arial", scaled_font(14), "bold"), text_color="white").pack(pady=10)
+        audit_fields = {k: v for k, v in field_mappings.items() if v in ('contact', 'locations_id', 'groups_id')}
+        field_var = tk.StringVar(value=next(iter(audit_fields), ''))
+        ctk.CTkComboBox(win, values=list(audit_fields), variable=field_var, width=200).pack(pady=5)
+        value_var = tk.StringVar()
+        value_combo = ctk.CTkComboBox(win, values=[], variable=value_var, width=300)
+        value_combo.pack(pady=5)
+        subtree_var = tk.BooleanVar(value=True)
+        ctk.CTkCheckBox(win, text="Местоположение: включая вложенные", variable=subtree_var,
+                        font=("Arial", scaled_font(12)), text_color="white").pack(pady=5)
+
+        def update_values(*args):
+            field = audit_fields.get(field_var.get())
+            if not field:
+                return
+            try:
+                values = self.dropdown_catalog().filter_choices(INDEXED_FIELDS[field])
+            except (GLPIError, ValueError) as e:
+                self.log(f"Ошибка загрузки значений для {field_var.get()}: {e}")
+                values = []
+            value_combo.configure(values=values)
+            value_var.set('')
+
+        def start_audit():
+            field = audit_fields.get(field_var.get())
+            value = value_var.get().strip()
+            if not field or not value:
+                messagebox.showwarning("Предупреждение", "Выберите поле и значение!")
+                return
+            if not use_indexing or not index_snapshot.serials:
+                messagebox.showwarning("Предупреждение", "Индекс ещё не построен или индексация отключена")
+                return
+            with timed('audit.start'):
+                items = self.indexed_items(field, value, subtree_var.get())
+            self.audit = AuditSession(f"{field_var.get()}: {value}", items)
+            self.update_audit_label()
+            # Найденными считаются только позиции, отсканированные после начала: то, что уже лежит в буфере
+            # или загружено списком из индекса, физически не проверено
+            self.log(f"Инвентаризация начата: {self.audit.title}, ожидается позиций: {len(self.audit.expected)}")
+            win.destroy()
+
+        field_var.trace_add('write', update_values)
+        update_values()
+        ctk.CTkButton(win, text="Начать", command=start_audit).pack(pady=10)
+        ctk.CTkButton(win, text="Закрыть", command=win.destroy).pack(pady=5)
+
+    def save_audit_report(self):
+        audit = self.audit
+        file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+        if not file_path:
+            return
+        entity_index = index_snapshot.entities
+        serials = index_snapshot.serials
+
+        def row(status, key, s):
+            found = self.found_items.get(s) or serials.get(s)
+            item = found[1] if found else {}
+            location = entity_index.get('Location', {}).get(str(item.get('locations_id')), '')
+            return [status, s, TYPE_NAMES.get(key[0], key[0]), str(item.get('name', '')),
+                    trim_location(location), str(item.get('contact', ''))]
+
+        try:
+            with timed('audit.report'):
+                with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f, delimiter=';')
+                    writer.writerow([f"# {audit.title}",
+                                     f"начата {time.strftime('%d.%m.%Y %H:%M', time.localtime(audit.started))}"])
+                    writer.writerow(["Статус", "Инв. номер", "Тип", "Наименование", "Местоположение по GLPI",
+                                     "Стеллаж по GLPI"])
+                    writer.writerows(row("Недостача", key, s) for key, s in audit.missing())
+                    writer.writerows(row("Лишнее", key, s) for key, s in audit.unexpected.items())
+                    writer.writerows(row("Найдено", key, audit.expected[key]) for key in audit.found)
+            expected, found, missing, unexpected = audit.counts()
+            self.log(f"Отчёт инвентаризации: найдено {found}/{expected}, недостаёт {missing}, лишних {unexpected}")
+            messagebox.showinfo("Успех", f"Отчёт сохранён в {file_path}")
+        except OSError as e:
+            messagebox.showerror("Ошибка", f"Ошибка сохранения отчёта: {e}")
+
+    def changes_window(self):
+        win = ctk.CTkToplevel(self.root)
+        win.title("Изменения между синхронизациями")
+        win.geometry("900x600")
+        win.transient(self.root)
+
+        top = ctk.CTkFrame(win, fg_color="#2d2d2d")
+        top.pack(fill='x', pady=5, padx=10)
+        days = change_days()
+        day_var = tk.StringVar(value=days[0] if days else '')
+        kind_var = tk.StringVar(value="Все")
+        ctk.CTkLabel(top, text="День:", font=("Arial", scaled_font(12)), text_color="white").pack(side='left', padx=5)
+        ctk.CTkComboBox(top, values=days, variable=day_var, width=140).pack(side='left', padx=5)
+        ctk.CTkComboBox(top, values=["Все"] + list(CHANGE_NAMES.values()), variable=kind_var,
+                        width=140).pack(side='left', padx=5)
+        summary_label = ctk.CTkLabel(win, text="", font=("Arial", scaled_font(12)), text_color="white")
+        summary_label.pack(pady=5)
+        text = ctk.CTkTextbox(win, font=("Arial", scaled_font(11)), wrap='none')
+        text.pack(fill='both', expand=True, padx=10, pady=5)
+        field_names = {v: k for k, v in field_mappings.items()}
+        shown = []
+
+        def describe(change):
+            deltas = "; ".join(f"{field_names.get(f, f)}: {old or '-'} → {new or '-'}"
+                               for f, (old, new) in change['fields'].items())
+            return (f"{time.strftime('%H:%M', time.localtime(change['time']))}  "
+                    f"{CHANGE_NAMES.get(change['change'], change['change'])}  {change['serial'] or '-'}  "
+                    f"{change['name']}" + (f"  |  {deltas}" if deltas else ""))
+
+        def refresh(*args):
+            changes = read_changes(day_var.get()) if day_var.get() else []
+            kinds = {v: k for k, v in CHANGE_NAMES.items()}
+            if kind_var.get() in kinds:
+                changes = [c for c in changes if c['change'] == kinds[kind_var.get()]]
+            shown[:] = changes
+            counts = {name: sum(1 for c in changes if c['change'] == k) for k, name in CHANGE_NAMES.items()}
+            summary_label.configure(text=", ".join(f"{name}: {n}" for name, n in counts.items()))
+            text.configure(state='normal')
+            text.delete("0.0", "end")
+            text.insert("end", "\n".join(describe(c) for c in changes[-CHANGES_SHOWN:][::-1]))
+            if len(changes) > CHANGES_SHOWN:
+                text.insert("end", f"\n... показаны последние {CHANGES_SHOWN} из {len(changes)}, остальные - в экспорте")
+            text.configure(state='disabled')
+
+        def export_changes():
+            if not shown:
+                messagebox.showwarning("Предупреждение", "Нет изменений для экспорта!")
+                return
+            file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+            if not file_path:
+                return
+            try:
+                with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f, delimiter=';')
+                    writer.writerow(["Время", "Изменение", "Тип", "Инв. номер", "Наименование", "Поле", "Было", "Стало"])
+                    for c in shown:
+                        head = [time.strftime('%d.%m.%Y %H:%M', time.localtime(c['time'])),
+                                CHANGE_NAMES.get(c['change'], c['change']), c['type'], c['serial'], c['name']]
+                        writer.writerows([head + [field_names.get(f, f), old, new]
+                                          for f, (old, new) in c['fields'].items()] or [head + ['', '', '']])
+                self.log(f"Лента изменений за {day_var.get()} выгружена: {len(shown)} записей")
+                messagebox.showinfo("Успех", f"Изменения сохранены в {file_path}")
+            except OSError as e:
+                messagebox.showerror("Ошибка", f"Ошибка экспорта изменений: {e}")
+
+        day_var.trace_add('write', refresh)
+        kind_var.trace_add('write', refresh)
+        refresh()
+        button_frame = ctk.CTkFrame(win, fg_color="#2d2d2d")
+        button_frame.pack(pady=5)
+        ctk.CTkButton(button_frame, text="Экспорт CSV", command=export_changes).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Закрыть", command=win.destroy).pack(side='left', padx=5)
+
+    def stats_window(self):
+        if not use_indexing or not index_snapshot.serials:
+            messagebox.showwarning("Предупреждение", "Индекс ещё не построен или индексация отключена")
+            return
+        win = ctk.CTkToplevel(self.root)
+        win.title("Статистика парка")
+        win.geometry("800x600")
+        win.transient(self.root)
+
+        field_names = {'type': 'Тип'}
+        field_names.update({v: k for k, v in field_mappings.items() if v in INDEXED_FIELDS})
+        by_name = {v: k for k, v in field_names.items()}
+        top = ctk.CTkFrame(win, fg_color="#2d2d2d")
+        top.pack(fill='x', pady=5, padx=10)
+        row_var = tk.StringVar(value=field_names.get('states_id', 'Тип'))
+        column_var = tk.StringVar(value="—")
+        ctk.CTkLabel(top, text="Группировать по:", font=("Arial", scaled_font(12)), text_color="white").pack(side='left', padx=5)
+        ctk.CTkComboBox(top, values=list(by_name), variable=row_var, width=160).pack(side='left', padx=5)
+        ctk.CTkLabel(top, text="и по:", font=("Arial", scaled_font(12)), text_color="white").pack(side='left', padx=5)
+        ctk.CTkComboBox(top, values=["—"] + list(by_name), variable=column_var, width=160).pack(side='left', padx=5)
+        summary_label = ctk.CTkLabel(win, text="", font=("Arial", scaled_font(12)), text_color="white")
+        summary_label.pack(pady=5)
+        text = ctk.CTkTextbox(win, font=("Courier New", scaled_font(11)), wrap='none')
+        text.pack(fill='both', expand=True, padx=10, pady=5)
+        result = {}
+
+        def label(snapshot, field, value):
+            if field == 'type':
+                return TYPE_NAMES.get(value, value)
+            return str(display_value(snapshot, field, value) or 'Не указано')
+
+        def refresh(*args):
+            stats, snapshot = self.fleet_stats(), index_snapshot
+            row_field, column_field = by_name.get(row_var.get()), by_name.get(column_var.get())
+            if stats is None or row_field not in stats.codes:
+                return
+            started = time.perf_counter()
+            # Разные коды могут дать одну подпись (например, удалённая запись справочника) - их счётчики складываются
+            counts = Counter()
+            if column_field in stats.codes and column_field != row_field:
+                for (r, c), n in stats.crosstab(row_field, column_field).items():
+                    counts[label(snapshot, row_field, r), label(snapshot, column_field, c)] += n
+            else:
+                column_field = None
+                for r, n in stats.count(row_field).items():
+                    counts[label(snapshot, row_field, r), ''] += n
+            elapsed = (time.perf_counter() - started) * 1000
+            result.update(row_field=row_field, column_field=column_field, counts=counts)
+            total = sum(counts.values())
+            summary_label.configure(text=f"Позиций: {total}, групп: {len(counts)}, расчёт {elapsed:.1f} мс")
+            lines = [f"{n:>7}  {r}" + (f"  /  {c}" if column_field else "")
+                     for (r, c), n in counts.most_common()]
+            text.configure(state='normal')
+            text.delete("0.0", "end")
+            text.insert("end", "\n".join(lines))
+            text.configure(state='disabled')
+
+        def export_stats():
+            if not result.get('counts'):
+                return
+            file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+            if not file_path:
+                return
+            counts, row_name = result['counts'], field_names[result['row_field']]
+            row_totals = Counter()
+            for (r, _), n in counts.items():
+                row_totals[r] += n
+            row_values = [r for r, _ in row_totals.most_common()]
+            try:
+                with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    writer = csv.writer(f, delimiter=';')
+                    if result['column_field']:
+                        # Сводная таблица: строки - значения первого поля, столбцы - второго
+                        column_values = sorted({c for _, c in counts})
+                        writer.writerow([row_name] + column_values + ["Итого"])
+                        for r in row_values:
+                            cells = [counts.get((r, c), 0) for c in column_values]
+                            writer.writerow([r] + cells + [row_totals[r]])
+                    else:
+                        writer.writerow([row_name, "Позиций"])
+                        writer.writerows([r, counts[(r, '')]] for r in row_values)
+                self.log(f"Статистика по полю {row_name} сохранена: {len(counts)} групп")
+                messagebox.showinfo("Успех", f"Статистика сохранена в {file_path}")
+            except OSError as e:
+                messagebox.showerror("Ошибка", f"Ошибка экспорта статистики: {e}")
+
+        row_var.trace_add('write', refresh)
+        column_var.trace_add('write', refresh)
+        refresh()
+        button_frame = ctk.CTkFrame(win, fg_color="#2d2d2d")
+        button_frame.pack(pady=5)
+        ctk.CTkButton(button_frame, text="Обновить", command=refresh).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Экспорт CSV", command=export_stats).pack(side='left', padx=5)
+        ctk.CTkButton(button_frame, text="Закрыть", command=win.destroy).pack(side='left', padx=5)
+
     def import_export_window(self):
         win = ctk.CTkToplevel(self.root)
         win.title("Импорт/Экспорт инвентарных номеров")
@@ -1462,7 +3863,7 @@ class GLPIApp:
         import_mode = tk.StringVar(value="excel")
         def show_import_frame(mode):
             import_mode.set(mode)
-            for f in [excel_frame, txt_frame, buffer_frame, filters_frame]:
+            for f in [excel_frame, txt_frame, buffer_frame, filters_frame, index_frame]:
                 f.pack_forget()
             if mode == "excel":
                 excel_frame.pack(fill='both', expand=True, pady=10)
@@ -1472,11 +3873,14 @@ class GLPIApp:
                 buffer_frame.pack(fill='both', expand=True, pady=10)
             elif mode == "filters":
                 filters_frame.pack(fill='both', expand=True, pady=10)
+            elif mode == "index":
+                index_frame.pack(fill='both', expand=True, pady=10)
         
         ctk.CTkButton(import_tab_frame, text="Excel", command=lambda: show_import_frame("excel"), width=120).pack(side='left', padx=5)
         ctk.CTkButton(import_tab_frame, text="TXT/CSV", command=lambda: show_import_frame("txt"), width=120).pack(side='left', padx=5)
         ctk.CTkButton(import_tab_frame, text="Буфер/Вставка", command=lambda: show_import_frame("buffer"), width=120).pack(side='left', padx=5)
         ctk.CTkButton(import_tab_frame, text="Фильтры", command=lambda: show_import_frame("filters"), width=120).pack(side='left', padx=5)
+        ctk.CTkButton(import_tab_frame, text="По индексу", command=lambda: show_import_frame("index"), width=120).pack(side='left', padx=5)
         
         # Excel импорт с выбором столбца
         excel_frame = ctk.CTkFrame(import_frame, fg_color="#232323")
@@ -1585,7 +3989,7 @@ class GLPIApp:
             field_combo = ctk.CTkComboBox(filter_frame, values=list(field_mappings.keys()), variable=field_var, width=120)
             field_combo.pack(side='left', padx=5, pady=5)
             operator_var = tk.StringVar(value="=")
-            operator_combo = ctk.CTkComboBox(filter_frame, values=["=", "!=", "Содержит", "Не содержит"], variable=operator_var, width=100)
+            operator_combo = ctk.CTkComboBox(filter_frame, values=["=", "!=", "Содержит", "Не содержит", "Внутри"], variable=operator_var, width=100)
             operator_combo.pack(side='left', padx=5, pady=5)
             # Значение: по умолчанию Entry, но если '=' и поле с ограниченным набором — ComboBox
             value_var = tk.StringVar()
@@ -1602,15 +4006,14 @@ class GLPIApp:
                 field = field_var.get()
                 op = operator_var.get()
                 # Для этих полей показываем выпадающий список
-                limited_fields = {
-                    'Департамент': lambda: sorted([v for v in entity_index.get('Group', {}).values() if v != 'Не указано'], key=str.lower),
-                    'Статус': lambda: sorted([v for v in entity_index.get('State', {}).values() if v != 'Не указано'], key=str.lower),
-                    'Местоположение': lambda: sorted([trim_location(v) for v in entity_index.get('Location', {}).values() if v != 'Не указано'], key=str.lower),
-                    'Пользователь': lambda: sorted([v for v in entity_index.get('User', {}).values() if v != 'Не указано'], key=str.lower),
-                    'Стеллаж': lambda: sorted(list(entity_index.get('Contact', set())), key=str.lower)
-                }
-                if op == '=' and field in limited_fields:
-                    values = limited_fields[field]()
+                limited_fields = {'Департамент': 'Group', 'Статус': 'State', 'Местоположение': 'Location',
+                                  'Пользователь': 'User', 'Стеллаж': 'Contact'}
+                if (op == '=' or op == 'Внутри' and field == 'Местоположение') and field in limited_fields:
+                    try:
+                        values = self.dropdown_catalog().filter_choices(limited_fields[field])
+                    except (GLPIError, ValueError) as e:
+                        self.log(f"Ошибка загрузки значений для {field}: {e}")
+                        values = []
                     if not values:
                         values = ['Не указано']
                     value_combo = ctk.CTkComboBox(filter_frame, values=values, width=150, variable=value_var)
@@ -1640,6 +4043,75 @@ class GLPIApp:
         
         ctk.CTkButton(filter_buttons_frame, text="Добавить фильтр", command=add_filter).pack(side='left', padx=5)
         
+        def filter_specs():
+            # Значения фильтров читаются в потоке Tk, проверка идёт уже по готовому списку
+            return [(f['logic'].get(), f['field'].get(), f['operator'].get(), f['value'].get().strip())
+                    for f in filters_list]
+
+        def item_matcher(specs, snapshot=None):
+            # Справочники, дерево и "Внутри" берутся из одного поколения индекса
+            snapshot = index_snapshot if snapshot is None else snapshot
+            entity_index = snapshot.entities
+            location_tree = snapshot.locations
+            within_ids = {}  # значение фильтра "Внутри" -> id местоположений
+
+            def matches_item(item_type, item):
+                matches = True
+                for i, (logic, field_name, operator, filter_value) in enumerate(specs):
+                    if not filter_value:
+                        continue
+
+                    # Получаем значение поля
+                    glpi_field = field_mappings[field_name]
+                    if glpi_field == 'type':
+                        item_value = TYPE_NAMES.get(item_type, item_type)
+                    elif glpi_field == 'otherserial':
+                        item_value = item.get('otherserial', '')
+                    elif glpi_field == 'users_id' and use_indexing and 'User' in entity_index:
+                        user_id = item.get('users_id')
+                        item_value = entity_index['User'].get(str(user_id), '') if user_id else ''
+                    elif glpi_field == 'groups_id' and use_indexing and 'Group' in entity_index:
+                        group_id = item.get('groups_id')
+                        item_value = entity_index['Group'].get(str(group_id), '') if group_id else ''
+                    elif glpi_field == 'states_id' and use_indexing and 'State' in entity_index:
+                        state_id = item.get('states_id')
+                        item_value = entity_index['State'].get(str(state_id), '') if state_id else ''
+                    elif glpi_field == 'locations_id' and use_indexing and 'Location' in entity_index:
+                        location_id = item.get('locations_id')
+                        location = entity_index['Location'].get(str(location_id), '') if location_id else ''
+                        item_value = trim_location(location)
+                    else:
+                        item_value = str(item.get(glpi_field, ''))
+
+                    # Применяем оператор
+                    field_matches = False
+                    if operator == "=":
+                        field_matches = str(item_value).lower() == filter_value.lower()
+                    elif operator == "!=":
+                        field_matches = str(item_value).lower() != filter_value.lower()
+                    elif operator == "Содержит":
+                        field_matches = filter_value.lower() in str(item_value).lower()
+                    elif operator == "Не содержит":
+                        field_matches = filter_value.lower() not in str(item_value).lower()
+                    elif operator == "Внутри" and glpi_field == 'locations_id':
+                        # Местоположение и всё, что в него вложено, по дереву индекса
+                        if filter_value not in within_ids:
+                            within_ids[filter_value] = self.entity_ids('Location', filter_value, snapshot)
+                        location_id = str(item.get('locations_id'))
+                        field_matches = any(location_tree.contains(k, location_id)
+                                            for k in within_ids[filter_value])
+
+                    # Применяем логику
+                    if i == 0:  # Первый фильтр
+                        matches = field_matches
+                    elif logic == "И":
+                        matches = matches and field_matches
+                    elif logic == "ИЛИ":
+                        matches = matches or field_matches
+                return matches
+
+            return matches_item
+
         def import_by_filters():
             if not filters_list:
                 messagebox.showwarning("Предупреждение", "Добавьте хотя бы один фильтр!")
@@ -1650,9 +4122,7 @@ class GLPIApp:
                 all_items = []
                 for item_type in ['Computer', 'Monitor', 'Peripheral']:
                     try:
-                        r = requests.get(f'{base_url}/{item_type}', headers=headers, params={'range': '0-9999'}, timeout=10)
-                        r.raise_for_status()
-                        data = r.json()
+                        data = glpi_request('GET', item_type, params={'range': '0-9999'})
                         if isinstance(data, list):
                             for item in data:
                                 if isinstance(item, dict) and 'id' in item:
@@ -1661,64 +4131,16 @@ class GLPIApp:
                         self.log(f"Ошибка загрузки {item_type}: {e}")
                 
                 # Применяем фильтры
+                matches_item = item_matcher(filter_specs())
+                filter_started = time.perf_counter()
                 filtered_items = []
                 for item_type, item in all_items:
-                    matches = True
-                    for i, filter_data in enumerate(filters_list):
-                        logic = filter_data['logic'].get()
-                        field_name = filter_data['field'].get()
-                        operator = filter_data['operator'].get()
-                        filter_value = filter_data['value'].get().strip()
-                        
-                        if not filter_value:
-                            continue
-                        
-                        # Получаем значение поля
-                        glpi_field = field_mappings[field_name]
-                        if glpi_field == 'type':
-                            item_value = {'Computer': 'Компьютер', 'Monitor': 'Монитор', 'Peripheral': 'Устройство'}.get(item_type, item_type)
-                        elif glpi_field == 'otherserial':
-                            item_value = item.get('otherserial', '')
-                        elif glpi_field == 'users_id' and use_indexing and 'User' in entity_index:
-                            user_id = item.get('users_id')
-                            item_value = entity_index['User'].get(str(user_id), '') if user_id else ''
-                        elif glpi_field == 'groups_id' and use_indexing and 'Group' in entity_index:
-                            group_id = item.get('groups_id')
-                            item_value = entity_index['Group'].get(str(group_id), '') if group_id else ''
-                        elif glpi_field == 'states_id' and use_indexing and 'State' in entity_index:
-                            state_id = item.get('states_id')
-                            item_value = entity_index['State'].get(str(state_id), '') if state_id else ''
-                        elif glpi_field == 'locations_id' and use_indexing and 'Location' in entity_index:
-                            location_id = item.get('locations_id')
-                            location = entity_index['Location'].get(str(location_id), '') if location_id else ''
-                            item_value = trim_location(location)
-                        else:
-                            item_value = str(item.get(glpi_field, ''))
-                        
-                        # Применяем оператор
-                        field_matches = False
-                        if operator == "=":
-                            field_matches = str(item_value).lower() == filter_value.lower()
-                        elif operator == "!=":
-                            field_matches = str(item_value).lower() != filter_value.lower()
-                        elif operator == "Содержит":
-                            field_matches = filter_value.lower() in str(item_value).lower()
-                        elif operator == "Не содержит":
-                            field_matches = filter_value.lower() not in str(item_value).lower()
-                        
-                        # Применяем логику
-                        if i == 0:  # Первый фильтр
-                            matches = field_matches
-                        elif logic == "И":
-                            matches = matches and field_matches
-                        elif logic == "ИЛИ":
-                            matches = matches or field_matches
-                    
-                    if matches:
+                    if matches_item(item_type, item):
                         # Получаем инвентарный номер
                         serial = item.get('otherserial', '').lstrip('0')
                         if serial:
                             filtered_items.append(serial)
+                perf.record('filter', time.perf_counter() - filter_started, items=len(all_items))
                 
                 # Импортируем найденные номера
                 self._import_serials(filtered_items)
@@ -1732,6 +4154,74 @@ class GLPIApp:
         
         # Добавляем первый фильтр по умолчанию
         add_filter()
+
+        # Импорт по индексу: всё оборудование пользователя, стеллажа, местоположения и т.п.
+        # берётся из обратных индексов, без загрузки таблиц
+        index_frame = ctk.CTkFrame(import_frame, fg_color="#232323")
+        ctk.CTkLabel(index_frame, text="Загрузить в буфер всё оборудование по значению поля",
+                     font=("Arial", scaled_font(12)), text_color="white").pack(pady=5)
+        index_fields = {k: v for k, v in field_mappings.items() if v in INDEXED_FIELDS}
+        index_field_var = tk.StringVar(value=next(iter(index_fields), ''))
+        ctk.CTkComboBox(index_frame, values=list(index_fields), variable=index_field_var, width=200).pack(pady=5)
+        index_value_var = tk.StringVar()
+        index_value_combo = ctk.CTkComboBox(index_frame, values=[], variable=index_value_var, width=300)
+        index_value_combo.pack(pady=5)
+        index_subtree_var = tk.BooleanVar(value=True)
+        ctk.CTkCheckBox(index_frame, text="Местоположение: включая вложенные", variable=index_subtree_var,
+                        font=("Arial", scaled_font(12)), text_color="white").pack(pady=5)
+        index_count_label = ctk.CTkLabel(index_frame, text="", font=("Arial", scaled_font(12)), text_color="white")
+        index_count_label.pack(pady=5)
+
+        def index_values(field_label):
+            field = index_fields.get(field_label)
+            if not field:
+                return []
+            try:
+                return self.dropdown_catalog().filter_choices(INDEXED_FIELDS[field])
+            except (GLPIError, ValueError) as e:
+                self.log(f"Ошибка загрузки значений для {field_label}: {e}")
+                return []
+
+        def update_index_values(*args):
+            if index_field_var.get() not in index_fields:
+                return
+            index_value_combo.configure(values=index_values(index_field_var.get()))
+            index_value_var.set('')
+            index_count_label.configure(text="")
+
+        def update_index_count(*args):
+            field = index_fields.get(index_field_var.get())
+            value = index_value_var.get().strip()
+            if field == 'locations_id' and value:
+                snapshot = index_snapshot
+                tree = snapshot.locations
+                ids = self.entity_ids('Location', value, snapshot)
+                own = sum(tree.own.get(k, 0) for k in ids)
+                total = sum(tree.total.get(k, 0) for k in ids)
+                index_count_label.configure(text=f"Позиций: {own}, с вложенными: {total}")
+            elif field and value:
+                index_count_label.configure(text=f"Позиций: {len(self.indexed_items(field, value))}")
+
+        def import_from_index():
+            field = index_fields.get(index_field_var.get())
+            value = index_value_var.get().strip()
+            if not field or not value:
+                messagebox.showwarning("Предупреждение", "Выберите поле и значение!")
+                return
+            if not use_indexing or not index_snapshot.serials:
+                messagebox.showwarning("Предупреждение", "Индекс ещё не построен или индексация отключена")
+                return
+            items = self.indexed_items(field, value, index_subtree_var.get())
+            if not items:
+                messagebox.showinfo("Информация", f"Нет оборудования: {index_field_var.get()} = {value}")
+                return
+            self._import_items(items)
+            win.destroy()
+
+        index_field_var.trace_add('write', update_index_values)
+        index_value_var.trace_add('write', update_index_count)
+        update_index_values()
+        ctk.CTkButton(index_frame, text="Загрузить в буфер", command=import_from_index).pack(pady=10)
         
         # Фрейм для экспорта
         export_frame = ctk.CTkFrame(win, fg_color="#232323")
@@ -1743,7 +4233,8 @@ class GLPIApp:
         export_mode = tk.StringVar(value="excel")
         def show_export_frame(mode):
             export_mode.set(mode)
-            for f in [export_excel_frame, export_txt_frame, export_buffer_frame]:
+            for f in [export_excel_frame, export_txt_frame, export_buffer_frame, compare_frame, report_frame,
+                      arrow_frame]:
                 f.pack_forget()
             if mode == "excel":
                 export_excel_frame.pack(fill='both', expand=True, pady=10)
@@ -1751,10 +4242,19 @@ class GLPIApp:
                 export_txt_frame.pack(fill='both', expand=True, pady=10)
             elif mode == "buffer":
                 export_buffer_frame.pack(fill='both', expand=True, pady=10)
+            elif mode == "compare":
+                compare_frame.pack(fill='both', expand=True, pady=10)
+            elif mode == "report":
+                report_frame.pack(fill='both', expand=True, pady=10)
+            elif mode == "arrow":
+                arrow_frame.pack(fill='both', expand=True, pady=10)
         
         ctk.CTkButton(export_tab_frame, text="Excel", command=lambda: show_export_frame("excel"), width=120).pack(side='left', padx=5)
         ctk.CTkButton(export_tab_frame, text="TXT/CSV", command=lambda: show_export_frame("txt"), width=120).pack(side='left', padx=5)
         ctk.CTkButton(export_tab_frame, text="Буфер", command=lambda: show_export_frame("buffer"), width=120).pack(side='left', padx=5)
+        ctk.CTkButton(export_tab_frame, text="Сравнение", command=lambda: show_export_frame("compare"), width=120).pack(side='left', padx=5)
+        ctk.CTkButton(export_tab_frame, text="Отчёт", command=lambda: show_export_frame("report"), width=120).pack(side='left', padx=5)
+        ctk.CTkButton(export_tab_frame, text="Parquet/Arrow", command=lambda: show_export_frame("arrow"), width=120).pack(side='left', padx=5)
         
         # Excel экспорт
         export_excel_frame = ctk.CTkFrame(export_frame, fg_color="#232323")
@@ -1767,6 +4267,7 @@ class GLPIApp:
             file_path = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx")])
             if not file_path:
                 return
+            export_started = time.perf_counter()
             try:
                 from openpyxl import Workbook
                 wb = Workbook()
@@ -1777,27 +4278,13 @@ class GLPIApp:
                 for col, header in enumerate(headers, 1):
                     ws.cell(row=1, column=col, value=header)
                 # Данные
+                entity_index = index_snapshot.entities
                 for row_idx, (serial, (item_type, item_data)) in enumerate(self.found_items.items(), start=2):
-                    for col_idx, display_name in enumerate(headers, 1):
-                        glpi_field = field_mappings[display_name]
-                        value = None
-                        if glpi_field == 'type':
-                            value = {'Computer': 'Компьютер', 'Monitor': 'Монитор', 'Peripheral': 'Устройство'}.get(item_type, item_type)
-                        elif glpi_field == 'otherserial':
-                            value = serial
-                        elif glpi_field == 'users_id' and use_indexing and 'User' in entity_index:
-                            value = entity_index['User'].get(str(item_data.get('users_id')), 'Не указано')
-                        elif glpi_field == 'groups_id' and use_indexing and 'Group' in entity_index:
-                            value = entity_index['Group'].get(str(item_data.get('groups_id')), 'Не указано')
-                        elif glpi_field == 'states_id' and use_indexing and 'State' in entity_index:
-                            value = entity_index['State'].get(str(item_data.get('states_id')), 'Не указано')
-                        elif glpi_field == 'locations_id' and use_indexing and 'Location' in entity_index:
-                            loc = entity_index['Location'].get(str(item_data.get('locations_id')), 'Не указано')
-                            value = trim_location(loc)
-                        else:
-                            value = item_data.get(glpi_field, 'Не указано')
+                    details = self.item_details.get((item_type, item_data.get('id')))
+                    for col_idx, value in enumerate(report_row(serial, item_type, item_data, entity_index, details), 1):
                         ws.cell(row=row_idx, column=col_idx, value=value)
                 wb.save(file_path)
+                perf.record('export.xlsx', time.perf_counter() - export_started, os.path.getsize(file_path))
                 self.log(f"Экспортировано в Excel: {len(self.found_items)} записей")
                 messagebox.showinfo("Успех", f"Экспортировано {len(self.found_items)} записей в {file_path}")
             except Exception as e:
@@ -1816,38 +4303,45 @@ class GLPIApp:
             file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv"), ("Text files", "*.txt")])
             if not file_path:
                 return
+            export_started = time.perf_counter()
             try:
                 headers = list(field_mappings.keys())
+                entity_index = index_snapshot.entities
                 with open(file_path, 'w', encoding='utf-8', newline='') as f:
                     f.write(";".join(headers) + "\n")
                     for serial, (item_type, item_data) in self.found_items.items():
-                        row = []
-                        for display_name in headers:
-                            glpi_field = field_mappings[display_name]
-                            value = None
-                            if glpi_field == 'type':
-                                value = {'Computer': 'Компьютер', 'Monitor': 'Монитор', 'Peripheral': 'Устройство'}.get(item_type, item_type)
-                            elif glpi_field == 'otherserial':
-                                value = serial
-                            elif glpi_field == 'users_id' and use_indexing and 'User' in entity_index:
-                                value = entity_index['User'].get(str(item_data.get('users_id')), 'Не указано')
-                            elif glpi_field == 'groups_id' and use_indexing and 'Group' in entity_index:
-                                value = entity_index['Group'].get(str(item_data.get('groups_id')), 'Не указано')
-                            elif glpi_field == 'states_id' and use_indexing and 'State' in entity_index:
-                                value = entity_index['State'].get(str(item_data.get('states_id')), 'Не указано')
-                            elif glpi_field == 'locations_id' and use_indexing and 'Location' in entity_index:
-                                loc = entity_index['Location'].get(str(item_data.get('locations_id')), 'Не указано')
-                                value = trim_location(loc)
-                            else:
-                                value = item_data.get(glpi_field, 'Не указано')
-                            row.append(str(value))
+                        details = self.item_details.get((item_type, item_data.get('id')))
+                        row = [str(value) for value in report_row(serial, item_type, item_data, entity_index, details)]
                         f.write(";".join(row) + "\n")
+                perf.record('export.csv', time.perf_counter() - export_started, os.path.getsize(file_path))
                 self.log(f"Экспортировано в TXT/CSV: {len(self.found_items)} записей")
                 messagebox.showinfo("Успех", f"Экспортировано {len(self.found_items)} записей в {file_path}")
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Ошибка экспорта в TXT/CSV: {e}")
         
         ctk.CTkButton(export_txt_frame, text="Экспортировать в TXT/CSV", command=export_txt).pack(pady=10)
+
+        def export_location_summary():
+            tree = index_snapshot.locations
+            if not tree.order:
+                messagebox.showwarning("Предупреждение", "Индекс местоположений ещё не построен!")
+                return
+            file_path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV files", "*.csv")])
+            if not file_path:
+                return
+            try:
+                with open(file_path, 'w', encoding='utf-8-sig', newline='') as f:
+                    # Названия местоположений могут содержать ';' и кавычки - экранирует csv.writer
+                    writer = csv.writer(f, delimiter=';')
+                    writer.writerow(["Местоположение", "Уровень", "Позиций", "С вложенными"])
+                    writer.writerows([trim_location(tree.paths[k]), tree.depth(k), tree.own[k], tree.total[k]]
+                                     for k in tree.order)
+                self.log(f"Сводка по местоположениям: {len(tree.order)} строк")
+                messagebox.showinfo("Успех", f"Сводка сохранена в {file_path}")
+            except OSError as e:
+                messagebox.showerror("Ошибка", f"Ошибка экспорта сводки: {e}")
+
+        ctk.CTkButton(export_txt_frame, text="Сводка по местоположениям", command=export_location_summary).pack(pady=10)
         
         # Экспорт в буфер
         export_buffer_frame = ctk.CTkFrame(export_frame, fg_color="#232323")
@@ -1857,45 +4351,246 @@ class GLPIApp:
             if not self.found_items:
                 messagebox.showwarning("Предупреждение", "Нет данных для экспорта!")
                 return
+            export_started = time.perf_counter()
             try:
                 headers = list(field_mappings.keys())
                 buffer_text = "\t".join(headers) + "\n"
+                entity_index = index_snapshot.entities
                 for serial, (item_type, item_data) in self.found_items.items():
-                    row = []
-                    for display_name in headers:
-                        glpi_field = field_mappings[display_name]
-                        value = None
-                        if glpi_field == 'type':
-                            value = {'Computer': 'Компьютер', 'Monitor': 'Монитор', 'Peripheral': 'Устройство'}.get(item_type, item_type)
-                        elif glpi_field == 'otherserial':
-                            value = serial
-                        elif glpi_field == 'users_id' and use_indexing and 'User' in entity_index:
-                            value = entity_index['User'].get(str(item_data.get('users_id')), 'Не указано')
-                        elif glpi_field == 'groups_id' and use_indexing and 'Group' in entity_index:
-                            value = entity_index['Group'].get(str(item_data.get('groups_id')), 'Не указано')
-                        elif glpi_field == 'states_id' and use_indexing and 'State' in entity_index:
-                            value = entity_index['State'].get(str(item_data.get('states_id')), 'Не указано')
-                        elif glpi_field == 'locations_id' and use_indexing and 'Location' in entity_index:
-                            loc = entity_index['Location'].get(str(item_data.get('locations_id')), 'Не указано')
-                            value = trim_location(loc)
-                        else:
-                            value = item_data.get(glpi_field, 'Не указано')
-                        row.append(str(value))
+                    details = self.item_details.get((item_type, item_data.get('id')))
+                    row = [str(value) for value in report_row(serial, item_type, item_data, entity_index, details)]
                     buffer_text += "\t".join(row) + "\n"
                 self.root.clipboard_clear()
                 self.root.clipboard_append(buffer_text)
+                perf.record('export.clipboard', time.perf_counter() - export_started, len(buffer_text.encode('utf-8')))
                 self.log(f"Скопировано в буфер: {len(self.found_items)} записей")
                 messagebox.showinfo("Успех", f"Скопировано {len(self.found_items)} записей в буфер обмена")
             except Exception as e:
                 messagebox.showerror("Ошибка", f"Ошибка копирования в буфер: {e}")
         
         ctk.CTkButton(export_buffer_frame, text="Копировать в буфер", command=export_to_buffer).pack(pady=10)
+
+        # Сравнение двух экземпляров GLPI
+        compare_frame = ctk.CTkFrame(export_frame, fg_color="#232323")
+        ctk.CTkLabel(compare_frame, text="Различия между двумя серверами из прессетов",
+                     font=("Arial", scaled_font(12)), text_color="white").pack(pady=10)
+        preset_names = [preset_name(h) for h in auth_history]
+        left_var = tk.StringVar(value=preset_names[0] if preset_names else '')
+        right_var = tk.StringVar(value=preset_names[1] if len(preset_names) > 1 else '')
+        ctk.CTkComboBox(compare_frame, values=preset_names, variable=left_var, width=300).pack(pady=5)
+        ctk.CTkComboBox(compare_frame, values=preset_names, variable=right_var, width=300).pack(pady=5)
+        compare_status = ctk.CTkLabel(compare_frame, text="", font=("Arial", scaled_font(11)), text_color="#aaaaaa")
+        compare_status.pack(pady=5)
+
+        def compare_done(future, file_path, left_name, right_name):
+            if compare_frame.winfo_exists():
+                compare_button.configure(state="normal")
+                compare_status.configure(text="")
+            try:
+                counts = future.result()
+            except Exception as e:
+                self.log(f"Ошибка сравнения экземпляров: {e}")
+                messagebox.showerror("Ошибка", f"Ошибка сравнения: {e}")
+                return
+            summary = (f"Только в {left_name}: {counts['removed']}\nТолько в {right_name}: {counts['added']}\n"
+                       f"Изменено: {counts['changed']}")
+            self.log(f"Сравнение {left_name} и {right_name}: " + summary.replace('\n', ', '))
+            messagebox.showinfo("Успех", f"{summary}\n\nОтчёт сохранён в {file_path}")
+
+        def compare():
+            presets = {preset_name(h): h for h in auth_history}
+            left, right = presets.get(left_var.get()), presets.get(right_var.get())
+            if not left or not right or left['base_url'] == right['base_url']:
+                messagebox.showwarning("Предупреждение", "Выберите два прессета с разными серверами!")
+                return
+            if self.offline:
+                messagebox.showwarning("Предупреждение", "Сравнение недоступно в офлайн-режиме")
+                return
+            file_path = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx"),
+                                                                                          ("CSV files", "*.csv")])
+            if not file_path:
+                return
+            left_name, right_name = preset_name(left), preset_name(right)
+            compare_button.configure(state="disabled")
+            compare_status.configure(text="Индексация обоих серверов...")
+            self.log(f"Сравнение экземпляров: {left_name} и {right_name}")
+            future = async_service.submit(compare_instances(self, left, right, file_path))
+            future.add_done_callback(lambda fut: self.ui(compare_done, fut, file_path, left_name, right_name))
+
+        compare_button = ctk.CTkButton(compare_frame, text="Сравнить и сохранить", command=compare)
+        compare_button.pack(pady=10)
+
+        # Отчёт по всему парку прямо из индекса: строки пишутся в файл порциями, в буфер ничего не попадает
+        report_frame = ctk.CTkFrame(export_frame, fg_color="#232323")
+        ctk.CTkLabel(report_frame, text="Отчёт по индексу без загрузки в буфер",
+                     font=("Arial", scaled_font(12)), text_color="white").pack(pady=10)
+        report_scopes = ["Весь парк", "По значению поля", "По фильтрам импорта"]
+        report_scope_var = tk.StringVar(value=report_scopes[0])
+        ctk.CTkComboBox(report_frame, values=report_scopes, variable=report_scope_var, width=300).pack(pady=5)
+        report_field_var = tk.StringVar(value=next(iter(index_fields), ''))
+        ctk.CTkComboBox(report_frame, values=list(index_fields), variable=report_field_var, width=200).pack(pady=5)
+        report_value_var = tk.StringVar()
+        report_value_combo = ctk.CTkComboBox(report_frame, values=[], variable=report_value_var, width=300)
+        report_value_combo.pack(pady=5)
+        report_subtree_var = tk.BooleanVar(value=True)
+        ctk.CTkCheckBox(report_frame, text="Местоположение: включая вложенные", variable=report_subtree_var,
+                        font=("Arial", scaled_font(12)), text_color="white").pack(pady=5)
+        report_status = ctk.CTkLabel(report_frame, text="", font=("Arial", scaled_font(11)), text_color="#aaaaaa")
+        report_status.pack(pady=5)
+
+        def update_report_values(*args):
+            report_value_combo.configure(values=index_values(report_field_var.get()))
+            report_value_var.set('')
+
+        def report_records(snapshot):
+            # Выборка из переданного поколения индекса; None, если условие не задано
+            scope = report_scope_var.get()
+            if scope == "По значению поля":
+                field, value = index_fields.get(report_field_var.get()), report_value_var.get().strip()
+                return (self.indexed_items(field, value, report_subtree_var.get(), snapshot)
+                        if field and value else None)
+            if scope == "По фильтрам импорта":
+                if not filters_list:
+                    return None
+                matches_item = item_matcher(filter_specs(), snapshot)
+                return (r for r in snapshot.serials.records() if matches_item(*r))
+            return snapshot.serials.records()
+
+        def report_done(future, file_path):
+            if report_frame.winfo_exists():
+                report_button.configure(state="normal")
+                report_status.configure(text="")
+            try:
+                written = future.result()
+            except Exception as e:
+                self.log(f"Ошибка выгрузки отчёта: {e}")
+                messagebox.showerror("Ошибка", f"Ошибка выгрузки отчёта: {e}")
+                return
+            self.log(f"Отчёт по индексу: {written} позиций -> {file_path}")
+            messagebox.showinfo("Успех", f"Выгружено {written} позиций в {file_path}")
+
+        def export_report():
+            # Записи и справочники - из одного поколения, даже если индекс обновится во время выгрузки
+            snapshot = index_snapshot
+            if not use_indexing or not snapshot.serials:
+                messagebox.showwarning("Предупреждение", "Индекс ещё не построен или индексация отключена")
+                return
+            records = report_records(snapshot)
+            if records is None:
+                messagebox.showwarning("Предупреждение", "Задайте условие выборки!")
+                return
+            file_path = filedialog.asksaveasfilename(defaultextension=".xlsx", filetypes=[("Excel files", "*.xlsx"),
+                                                                                          ("CSV files", "*.csv")])
+            if not file_path:
+                return
+            report_button.configure(state="disabled")
+            report_status.configure(text="Выгрузка...")
+            future = self.lookup_pool.submit(
+                stream_report, file_path, records, snapshot.entities,
+                lambda n: self.ui(lambda: report_status.configure(text=f"Записано позиций: {n}")))
+            future.add_done_callback(lambda fut: self.ui(report_done, fut, file_path))
+
+        report_field_var.trace_add('write', update_report_values)
+        update_report_values()
+        report_button = ctk.CTkButton(report_frame, text="Сохранить отчёт", command=export_report)
+        report_button.pack(pady=10)
+
+        # Parquet/Arrow: типизированные столбцы для аналитики (id - целыми, названия - словарём)
+        arrow_frame = ctk.CTkFrame(export_frame, fg_color="#232323")
+        ctk.CTkLabel(arrow_frame, text="Экспорт в Parquet или Arrow" if pa is not None else
+                     "Для экспорта в Parquet/Arrow нужен пакет pyarrow",
+                     font=("Arial", scaled_font(12)), text_color="white").pack(pady=10)
+        arrow_status = ctk.CTkLabel(arrow_frame, text="", font=("Arial", scaled_font(11)), text_color="#aaaaaa")
+        arrow_status.pack(pady=5)
+
+        def arrow_done(future, file_path):
+            if arrow_frame.winfo_exists():
+                for button in arrow_buttons:
+                    button.configure(state="normal")
+                arrow_status.configure(text="")
+            try:
+                written = future.result()
+            except Exception as e:
+                self.log(f"Ошибка экспорта в Parquet/Arrow: {e}")
+                messagebox.showerror("Ошибка", f"Ошибка экспорта в Parquet/Arrow: {e}")
+                return
+            self.log(f"Экспорт в Parquet/Arrow: {written} позиций -> {file_path}")
+            messagebox.showinfo("Успех", f"Экспортировано {written} позиций в {file_path}")
+
+        def export_arrow(scope):
+            snapshot = index_snapshot
+            if scope == 'fleet':
+                if not use_indexing or not snapshot.serials:
+                    messagebox.showwarning("Предупреждение", "Индекс ещё не построен или индексация отключена")
+                    return
+                records = snapshot.serials.records()
+                metadata = {'source': snapshot.source, 'generation': snapshot.generation,
+                            'built_at': snapshot.built_at}
+            else:
+                if not self.found_items:
+                    messagebox.showwarning("Предупреждение", "Нет данных для экспорта!")
+                    return
+                records = list(self.found_items.values())
+                metadata = {'source': base_url, 'scope': 'buffer', 'exported_at': time.time()}
+            file_path = filedialog.asksaveasfilename(defaultextension=".parquet", filetypes=[
+                ("Parquet files", "*.parquet"), ("Arrow files", "*.arrow")])
+            if not file_path:
+                return
+            for button in arrow_buttons:
+                button.configure(state="disabled")
+            arrow_status.configure(text="Выгрузка...")
+            future = self.lookup_pool.submit(
+                write_arrow, file_path, records, snapshot.entities, metadata,
+                lambda n: self.ui(lambda: arrow_status.configure(text=f"Записано позиций: {n}")))
+            future.add_done_callback(lambda fut: self.ui(arrow_done, fut, file_path))
+
+        arrow_state = "normal" if pa is not None else "disabled"
+        arrow_buttons = [
+            ctk.CTkButton(arrow_frame, text="Весь парк из индекса", command=lambda: export_arrow('fleet'),
+                          state=arrow_state),
+            ctk.CTkButton(arrow_frame, text="Буфер", command=lambda: export_arrow('buffer'), state=arrow_state)]
+        for button in arrow_buttons:
+            button.pack(pady=5)
         
         # Показываем импорт по умолчанию
         show_import_frame("excel")
         import_frame.pack(fill='both', expand=True, pady=5, padx=10)
         
         ctk.CTkButton(win, text="Закрыть", command=win.destroy, font=("Arial", scaled_font(12))).pack(pady=10)
+
+    def indexed_items(self, field, display, subtree=False, snapshot=None):
+        # Позиции со значением поля display: справочник просматривается целиком,
+        # оборудование - только найденные списки из обратного индекса.
+        # subtree - для местоположения вместе со всеми вложенными
+        snapshot = index_snapshot if snapshot is None else snapshot
+        entity = INDEXED_FIELDS[field]
+        if entity == 'Contact':
+            return list(snapshot.items_by(field, display))
+        ids = self.entity_ids(entity, display, snapshot)
+        if entity == 'Location' and subtree:
+            return [item for k in ids for item in snapshot.locations.items(k)]
+        return [item for k in ids for item in snapshot.items_by(field, k)]
+
+    @staticmethod
+    def entity_ids(entity, display, snapshot=None):
+        snapshot = index_snapshot if snapshot is None else snapshot
+        table = snapshot.entities.get(entity, {})
+        return [k for k, v in table.items() if isinstance(v, str) and
+                (trim_location(v) if entity == 'Location' else v) == display]
+
+    def _import_items(self, items):
+        # Позиции уже известны из индекса: строки буфера заполняются сразу, без поиска на сервере
+        count = 0
+        with timed('buffer.import_items'):
+            for t, item in items:
+                s = item_serial(item)
+                if s:
+                    self._process_single_item(s, (t, item), self._add_buffer_row(s), quiet=True)
+                    count += 1
+        self.update_counters()
+        self.play_sound(count > 0)
+        self.log(f"Добавлено в буфер из индекса: {count}")
+
     def _import_serials(self, numbers):
         count = 0
         for s in numbers:
@@ -1919,12 +4614,14 @@ def start():
 def on_closing(app):
     if 'Session-Token' in headers:
         try:
-            requests.get(f'{base_url}/killSession', headers=headers, timeout=5)
+            glpi_request('GET', 'killSession', timeout=5)
             app.log("Сессия завершена")
-        except requests.RequestException as e:
+        except GLPIError as e:
             app.log(f"Ошибка завершения сессии: {e}")
         except Exception as e:
             app.log(f"Неожиданная ошибка при завершении сессии: {e}")
+    async_service.stop()
+    feedback.stop()
     app.root.destroy()
     print("DEBUG: Программа завершена")
 